@@ -1,2 +1,2 @@
 from inquisitor.configs import CACHE_PATH
-from inquisitor.templates import cache_image, LinearCrawler, RedditScraper
\ No newline at end of file
+from inquisitor.templates import cache_image, session, LinearCrawler, RedditScraper
\ No newline at end of file
@@ -1,24 +1,59 @@
 # Standard library imports
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import hashlib
+import itertools
+import json
+import mimetypes
 import os
+import threading
 import traceback
+from urllib.parse import quote, urlencode
 
 # Third party imports
-from flask import Flask, render_template, request, jsonify, abort, redirect, url_for
+from flask import (
+	Flask, Response, stream_template, request, jsonify, abort, redirect, url_for,
+	make_response, stream_with_context, send_from_directory)
+from werkzeug.security import safe_join
+from werkzeug.http import is_resource_modified
 
 # Application imports
 from inquisitor.configs import (
 	DUNGEON_PATH,
 	SOURCES_PATH,
 	CACHE_PATH,
+	CACHE_OFFLOAD,
+	CACHE_ACCEL_PATH,
+	ITEM_CACHE_BYTES,
+	LIVE_FEED,
 	subfeeds,
 	get_subfeed_overrides,
 	logger,
 	init_default_logging)
-from inquisitor import sources, loader, timestamp
+from inquisitor import loader, paging, timestamp
+from inquisitor.jobs import job_queue
+
+# Items shown per page by default and at most
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Item bodies sent with a page, in bytes, before the rest are left for the
+# page to fetch when they are expanded
+PAGE_BODY_BYTES = 1024 * 1024
+
+# How long clients may reuse cached files before revalidating, in seconds
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
 
 # Globals
 app = Flask(__name__)
+app.config['USE_X_SENDFILE'] = (CACHE_OFFLOAD == 'x-sendfile')
+feed_view = None
+feed_view_lock = threading.Lock()
+# Feed sources -> (generation, last reveal, next reveal), reused until the
+# dungeon changes or the next hidden item is due
+reveal_cache = {}
+reveal_cache_lock = threading.Lock()
+
+# Keep parsed items in memory between requests
+loader.enable_item_cache(ITEM_CACHE_BYTES)
 
 
 def make_query_link(text, wl, bl):
@@ -28,6 +63,17 @@ def make_query_link(text, wl, bl):
 	query = "?{}".format("&".join(params))
 	return '<a href="{1}">{0}</a>'.format(text, query)
 
+def make_page_url(wl, bl, after, limit, default_limit=PAGE_SIZE):
+	params = []
+	if wl:
+		params.append(('only', ",".join(wl)))
+	if bl:
+		params.append(('not', ",".join(bl)))
+	params.append(('after', after))
+	if limit != default_limit:
+		params.append(('limit', limit))
+	return "?" + urlencode(params, safe=',')
+
 @app.template_filter("datetimeformat")
 def datetimeformat(value):
 	return timestamp.stamp_to_readable(value) if value is not None else ""
@@ -42,60 +88,175 @@ def feed():
 
 @app.route("/feed/<string:feed_name>/")
 def subfeed(feed_name):
+	source_names = subfeed_sources(feed_name)
+	if source_names is None:
+		return abort(404)
+	return feed_for_sources(source_names)
+
+def subfeed_sources(feed_name):
+	"""
+	Returns the sources in a subfeed, or None if there is no such subfeed.
+	"""
 	# Check for and apply subfeed overrides
 	subfeed_overrides = get_subfeed_overrides()
 	subfeed_config = subfeed_overrides or subfeeds or {}
 
 	# The built-in inquisitor subfeed contains sources not in another subfeed
 	if feed_name == 'inquisitor':
-		all_sources = os.listdir(DUNGEON_PATH)
+		all_sources = loader.get_cells()
 		for subfeed, sources in subfeed_config.items():
 			for source_name in sources:
 				if source_name in all_sources:
 					all_sources.remove(source_name)
-		return feed_for_sources(all_sources)
+		return all_sources
 
-	if feed_name not in subfeed_config:
-		return abort(404)
-	return feed_for_sources(subfeed_config[feed_name])
+	return subfeed_config.get(feed_name)
 
-def feed_for_sources(source_names):
-	# Determine exclusion filters
-	filters = []
+def live_feed():
+	"""
+	Returns the live feed view if it is enabled, starting it on first use
+	in this process. A view that fails is dropped for scanning.
+	"""
+	global feed_view
+	if not LIVE_FEED:
+		return None
+	with feed_view_lock:
+		if feed_view is None:
+			try:
+				from inquisitor.livefeed import LiveFeed
+				view = LiveFeed(loader.storage)
+				view.start()
+				feed_view = view
+			except Exception as e:
+				logger.error(f'Could not start the live feed, scanning instead: {e}')
+				feed_view = False
+		elif feed_view and feed_view.failed:
+			logger.error('The live feed has failed, scanning instead')
+			feed_view = False
+	return feed_view
+
+def feed_params(default_limit, max_limit):
+	"""
+	Returns the tag filters, cursor position and page size in the query
+	string. Raises ValueError if the cursor is malformed.
+	"""
 	wl_param = request.args.get('only')
 	wl = wl_param.split(",") if wl_param else []
 	bl_param = request.args.get('not')
 	bl = bl_param.split(",") if bl_param else []
-	if wl:
-		filters.append(lambda item: not any([tag in wl for tag in item['tags']]))
-	if bl:
-		filters.append(lambda item: any([tag in bl for tag in item['tags']]))
-
-	# Get all active+filtered items and all active tags
-	total = 0
-	items, errors = loader.load_active_items(source_names)
-	active_items = []
-	active_tags = {}
-	for item in items:
-		if item['active']:
-			for tag in item['tags']:
-				if tag not in active_tags: active_tags[tag] = 0
-				active_tags[tag] += 1
-			# active_tags |= set(item['tags'])
-			total += 1
-			if not any(map(lambda f: f(item), filters)):
-				active_items.append(item)
-	# Sort items by time
-	active_items.sort(key=lambda i: i['time'] if 'time' in i and i['time'] else i['created'] if 'created' in i and i['created'] else 0)
-
-	logger.info("Returning {} of {} items".format(len(active_items), total))
+	after_param = request.args.get('after')
+	after = paging.decode_cursor(after_param) if after_param else None
+	limit = request.args.get('limit', default_limit, type=int)
+	if limit is not None:
+		limit = max(1, limit)
+		if max_limit is not None:
+			limit = min(limit, max_limit)
+	return wl, bl, after, limit
+
+def select_page(source_names, wl, bl, after, limit):
+	"""
+	Returns the first `limit` active items after the position `after` from
+	the given sources that pass the tag filters, the number of items that
+	pass the filters, the total number of items, and the count of each tag
+	among them.
+	"""
+	view = live_feed()
+	if view:
+		return view.select(source_names, wl, bl, after, limit)
+	return loader.select_entries(source_names, wl, bl, after, limit)
+
+def render_items(page):
+	"""
+	Loads the items on a page as they are rendered. Their bodies are sent
+	with them until the page's body budget is spent, and after that they
+	are fetched by the page when they are expanded.
+	"""
+	budget = PAGE_BODY_BYTES
+	errors = []
+	for item, error in loader.iter_entries(page):
+		if error:
+			errors.append(error)
+			continue
+		active_item = item.headers()
+		body_size = item.body_size()
+		if body_size is not None and body_size <= budget:
+			active_item['body'] = item['body']
+			budget -= body_size
+		else:
+			active_item['has_body'] = body_size is not None
+		yield active_item
 	if errors:
-		read_ex = {
+		yield {
 			'title': 'Read errors',
 			'body': "<pre>{}</pre>".format("\n\n".join(errors)),
 			'created': None,
 		}
-		active_items.insert(0, read_ex)
+
+def feed_validators(source_names):
+	"""
+	Returns the ETag and Last-Modified time of the feed page being requested.
+	They change whenever an item is created, changed or deleted, or revealed
+	by its time-to-show passing, or the sources in the feed change, and
+	differ by path and query string. They come from the dungeon's
+	generation counter, which every process sees, whether or not the page
+	is served from the live feed.
+	"""
+	generation, modified = loader.generation()
+	revealed = feed_last_reveal(source_names, generation)
+	version = (generation, modified, revealed)
+	modified = max(filter(None, (modified, revealed)), default=None)
+	storage = (type(loader.storage).__name__, loader.storage.path)
+	sources = sorted(source_names) if source_names is not None else None
+	key = repr((storage, version, sources, request.full_path)).encode('utf8')
+	etag = hashlib.sha1(key).hexdigest()
+	if modified is not None:
+		modified = datetime.fromtimestamp(int(modified), timezone.utc)
+	return etag, modified
+
+def feed_last_reveal(source_names, generation):
+	"""
+	Returns the latest time an item in the given sources was revealed by its
+	time-to-show passing. The reveal times are only looked up again when
+	the dungeon has changed or the next hidden item is due.
+	"""
+	key = tuple(source_names) if source_names is not None else None
+	with reveal_cache_lock:
+		cached = reveal_cache.get(key)
+	if cached:
+		cached_generation, revealed, upcoming = cached
+		if cached_generation == generation and (upcoming is None or timestamp.now() < upcoming):
+			return revealed
+	revealed, upcoming = loader.reveal_times(source_names)
+	with reveal_cache_lock:
+		reveal_cache[key] = (generation, revealed, upcoming)
+	return revealed
+
+def feed_for_sources(source_names):
+	# Answer from the client's cached copy if nothing has changed. This is
+	# checked before any items are loaded.
+	etag, modified = feed_validators(source_names)
+	if not is_resource_modified(request.environ, etag, last_modified=modified):
+		response = make_response('', 304)
+		response.set_etag(etag)
+		response.last_modified = modified
+		return response
+
+	# Determine tag filters and the page
+	try:
+		wl, bl, after, limit = feed_params(PAGE_SIZE, MAX_PAGE_SIZE)
+	except ValueError:
+		return abort(400)
+
+	# Get the requested page of active+filtered items, plus one to see if
+	# there is a next page, and count all active tags
+	page, filtered, total, active_tags = select_page(source_names, wl, bl, after, limit + 1)
+	next_page = None
+	if len(page) > limit:
+		page = page[:limit]
+		next_page = make_page_url(wl, bl, paging.encode_cursor(page[-1]), limit)
+
+	logger.info("Returning {} of {} items".format(filtered, total))
+	pseudo_items = []
 
 	if total > 0:
 		# Create the feed control item
@@ -120,29 +281,77 @@ def feed_for_sources(source_names):
 		body = '<table class="feed-control">{}</table>'.format("\n".join(link_table))
 
 		feed_control = {
-			'title': 'Feed Control [{}/{}]'.format(len(active_items), total),
+			'title': 'Feed Control [{}/{}]'.format(filtered, total),
 			'body': body,
 		}
-		active_items.insert(0, feed_control)
+		pseudo_items.append(feed_control)
 
-	selection = active_items[:100]
-
-	return render_template("feed.jinja2",
-		items=selection,
+	# The page is streamed out as its items are loaded
+	response = make_response(stream_template("feed.jinja2",
+		items=itertools.chain(pseudo_items, render_items(page)),
+		count=len(page),
+		next_page=next_page,
 		mdeac=[
-			{'source': item['source'], 'itemid': item['id']}
-			for item in selection
-			if 'id' in item])
+			{'source': entry['source'], 'itemid': entry['id']}
+			for entry in page]))
+	# Clients must revalidate before reusing the page
+	response.set_etag(etag)
+	response.last_modified = modified
+	response.cache_control.no_cache = True
+	return response
+
+@app.route("/api/feed/")
+def api_feed():
+	return api_feed_for_sources(source_names=None)
+
+@app.route("/api/feed/<string:feed_name>/")
+def api_subfeed(feed_name):
+	source_names = subfeed_sources(feed_name)
+	if source_names is None:
+		return abort(404)
+	return api_feed_for_sources(source_names)
+
+def api_feed_for_sources(source_names):
+	"""
+	Streams the feed as newline-delimited JSON items, read as they are
+	written out. All matching items are returned unless a limit is given,
+	in which case a Link header points to the next page.
+	"""
+	try:
+		wl, bl, after, limit = feed_params(None, None)
+	except ValueError:
+		return abort(400)
+	page, _, _, _ = select_page(source_names, wl, bl, after, limit + 1 if limit else None)
+	next_page = None
+	if limit and len(page) > limit:
+		page = page[:limit]
+		next_page = make_page_url(wl, bl, paging.encode_cursor(page[-1]), limit, None)
+
+	def generate():
+		for item, error in loader.iter_entries(page):
+			if error:
+				logger.warning(f'Could not read {error}')
+				continue
+			yield json.dumps(item.item) + '\n'
+
+	response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+	if next_page:
+		response.headers['Link'] = f'<{request.path}{next_page}>; rel="next"'
+	return response
 
 @app.route("/deactivate/", methods=['POST'])
 def deactivate():
 	params = request.get_json()
 	if 'source' not in params and 'itemid' not in params:
 		logger.error("Bad request params: {}".format(params))
-	item = loader.load_item(params['source'], params['itemid'])
-	if item['active']:
-		logger.debug(f"Deactivating {params['source']}/{params['itemid']}")
-	item['active'] = False
+	with loader.batch():
+		item = loader.load_item(params['source'], params['itemid'])
+		if item['active']:
+			logger.debug(f"Deactivating {params['source']}/{params['itemid']}")
+		item['active'] = False
+	view = live_feed()
+	if view:
+		view.refresh(params['source'], params['itemid'])
 	return jsonify({'active': item['active']})
 
 @app.route("/punt/", methods=['POST'])
@@ -150,25 +359,39 @@ def punt():
 	params = request.get_json()
 	if 'source' not in params and 'itemid' not in params:
 		logger.error("Bad request params: {}".format(params))
-	item = loader.load_item(params['source'], params['itemid'])
-	tomorrow = datetime.now() + timedelta(days=1)
-	morning = datetime(tomorrow.year, tomorrow.month, tomorrow.day, 6, 0, 0)
-	til_then = morning.timestamp() - item['created']
-	item['tts'] = til_then
+	with loader.batch():
+		item = loader.load_item(params['source'], params['itemid'])
+		tomorrow = datetime.now() + timedelta(days=1)
+		morning = datetime(tomorrow.year, tomorrow.month, tomorrow.day, 6, 0, 0)
+		til_then = morning.timestamp() - item['created']
+		item['tts'] = til_then
+	view = live_feed()
+	if view:
+		view.refresh(params['source'], params['itemid'])
 	return jsonify(item.item)
 
+@app.route("/body/", methods=['POST'])
+def body():
+	params = request.get_json()
+	if 'source' not in params and 'itemid' not in params:
+		logger.error("Bad request params: {}".format(params))
+	item = loader.load_item(params['source'], params['itemid'])
+	return jsonify({'body': item.get('body')})
+
 @app.route("/mass-deactivate/", methods=['POST'])
 def mass_deactivate():
 	params = request.get_json()
 	if 'items' not in params:
 		logger.error("Bad request params: {}".format(params))
-	for info in params.get('items', []):
-		source = info['source']
-		itemid = info['itemid']
-		item = loader.load_item(source, itemid)
-		if item['active']:
-			logger.debug(f"Deactivating {info['source']}/{info['itemid']}")
-		item['active'] = False
+	item_keys = [
+		(info['source'], info['itemid'])
+		for info in params.get('items', [])]
+	count = loader.deactivate_items(item_keys)
+	logger.debug(f"Deactivated {count} of {len(item_keys)} items")
+	view = live_feed()
+	if view:
+		for source, itemid in item_keys:
+			view.refresh(source, itemid)
 	return jsonify({})
 
 @app.route("/callback/", methods=['POST'])
@@ -176,17 +399,38 @@ def callback():
 	params = request.get_json()
 	if 'source' not in params and 'itemid' not in params:
 		logger.error("Bad request params: {}".format(params))
-	logger.info('Executing callback for {}/{}'.format(params['source'], params['itemid']))
-	sources.item_callback(params['source'], params['itemid'])
-	return jsonify({})
+	logger.info('Queueing callback for {}/{}'.format(params['source'], params['itemid']))
+	job_id = job_queue.submit(params['source'], params['itemid'])
+	return jsonify({'job': job_id}), 202
+
+@app.route("/callback/<job_id>/")
+def callback_status(job_id):
+	job = job_queue.status(job_id)
+	if job is None:
+		return abort(404)
+	return jsonify(job)
+
+@app.route("/stats/")
+def stats():
+	return jsonify({'item_cache': loader.cache_stats()})
 
 @app.route('/cache/<path:cache_path>')
 def cache(cache_path):
-	path = os.path.join(CACHE_PATH, cache_path)
-	if not os.path.isfile(path):
-		return abort(404)
-	with open(path, 'rb') as f:
-		return f.read()
+	if CACHE_OFFLOAD == 'x-accel-redirect':
+		# nginx serves the file from its internal location
+		path = safe_join(CACHE_PATH, cache_path)
+		if path is None or not os.path.isfile(path):
+			return abort(404)
+		response = make_response('')
+		response.headers['X-Accel-Redirect'] = CACHE_ACCEL_PATH + quote(cache_path)
+		response.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+		response.cache_control.public = True
+		response.cache_control.max_age = CACHE_MAX_AGE
+		return response
+	# The file is streamed by the server's file wrapper, which uses
+	# sendfile where available, and Range and conditional requests are
+	# answered from its size and mtime
+	return send_from_directory(CACHE_PATH, cache_path, max_age=CACHE_MAX_AGE)
 
 
 def wsgi():
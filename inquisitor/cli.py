@@ -17,6 +17,23 @@ def command_test(args):
 		CONFIG_DATA, data_path,
 		CONFIG_SOURCES, source_path,
 		CONFIG_CACHE, cache_path,
+		CONFIG_CACHE_SIZE, cache_size_limit,
+		CONFIG_CACHE_FILE_SIZE, cache_file_limit,
+		CONFIG_CACHE_OFFLOAD, cache_offload,
+		CONFIG_CACHE_ACCEL_PATH, cache_accel_path,
+		CONFIG_STORAGE, storage_backend,
+		CONFIG_DATABASE, database_path,
+		CONFIG_ITEM_ENCODING, item_encoding,
+		CONFIG_ITEM_CACHE, item_cache_bytes,
+		CONFIG_SCAN_THREADS, scan_threads,
+		CONFIG_LIVE_FEED, live_feed,
+		CONFIG_HTTP_TIMEOUT, http_timeout,
+		CONFIG_HTTP_RETRIES, http_retries,
+		CONFIG_HTTP_HOST_CONNECTIONS, http_host_connections,
+		CONFIG_HTTP_HOST_INTERVAL, http_host_interval,
+		CONFIG_UPDATE_INTERVAL, update_interval,
+		CONFIG_UPDATE_INTERVALS, update_intervals,
+		CONFIG_CALLBACK_WORKERS, callback_workers,
 		CONFIG_LOGFILE, log_file,
 		CONFIG_VERBOSE, is_verbose,
 		CONFIG_SUBFEEDS, subfeeds,
@@ -33,6 +50,26 @@ def command_test(args):
 	print(f'    {CONFIG_DATA} = {data_path}')
 	print(f'    {CONFIG_SOURCES} = {source_path}')
 	print(f'    {CONFIG_CACHE} = {cache_path}')
+	print(f'    {CONFIG_CACHE_SIZE} = {cache_size_limit}')
+	print(f'    {CONFIG_CACHE_FILE_SIZE} = {cache_file_limit}')
+	print(f'    {CONFIG_CACHE_OFFLOAD} = {cache_offload}')
+	print(f'    {CONFIG_CACHE_ACCEL_PATH} = {cache_accel_path}')
+	print(f'    {CONFIG_STORAGE} = {storage_backend}')
+	print(f'    {CONFIG_DATABASE} = {database_path}')
+	print(f'    {CONFIG_ITEM_ENCODING} = {item_encoding}')
+	print(f'    {CONFIG_ITEM_CACHE} = {item_cache_bytes}')
+	print(f'    {CONFIG_SCAN_THREADS} = {scan_threads}')
+	print(f'    {CONFIG_LIVE_FEED} = {live_feed}')
+	print(f'    {CONFIG_HTTP_TIMEOUT} = {http_timeout}')
+	print(f'    {CONFIG_HTTP_RETRIES} = {http_retries}')
+	print(f'    {CONFIG_HTTP_HOST_CONNECTIONS} = {http_host_connections}')
+	print(f'    {CONFIG_HTTP_HOST_INTERVAL} = {http_host_interval}')
+	print(f'    {CONFIG_UPDATE_INTERVAL} = {update_interval}')
+	update_intervals = '; '.join(
+		f'{source_name}: {seconds:g}'
+		for source_name, seconds in update_intervals.items())
+	print(f'    {CONFIG_UPDATE_INTERVALS} = {update_intervals}')
+	print(f'    {CONFIG_CALLBACK_WORKERS} = {callback_workers}')
 	print(f'    {CONFIG_LOGFILE} = {log_file}')
 	print(f'    {CONFIG_VERBOSE} = {is_verbose}')
 	print(f'    {CONFIG_SUBFEEDS} = {subfeeds}')
@@ -48,8 +85,21 @@ def command_update(args):
 	parser.add_argument("source",
 		nargs="*",
 		help="Sources to update.")
+	parser.add_argument("--jobs", "-j",
+		type=int,
+		default=1,
+		help="Number of sources to update in parallel.")
+	parser.add_argument("--timeout",
+		type=float,
+		help="Seconds after which an update is killed.")
 	args = parser.parse_args(args)
 
+	if args.jobs < 1:
+		logger.error("--jobs must be at least 1")
+		return -1
+	if args.timeout is not None and args.timeout <= 0:
+		logger.error("--timeout must be positive")
+		return -1
 	if len(args.source) == 0:
 		parser.print_help()
 		return 0
@@ -61,7 +111,45 @@ def command_update(args):
 
 	# Update sources
 	from inquisitor.sources import update_sources
-	update_sources(*args.source)
+	update_sources(*args.source, jobs=args.jobs, timeout=args.timeout)
+	return 0
+
+
+def command_daemon(args):
+	"""Keep updating the specified sources on their update intervals."""
+	parser = argparse.ArgumentParser(
+		prog="inquisitor daemon",
+		description=command_daemon.__doc__,
+		add_help=False)
+	parser.add_argument("source",
+		nargs="*",
+		help="Sources to update.")
+	parser.add_argument("--jobs", "-j",
+		type=int,
+		default=1,
+		help="Number of sources to update in parallel.")
+	parser.add_argument("--timeout",
+		type=float,
+		help="Seconds after which an update is killed.")
+	args = parser.parse_args(args)
+
+	if args.jobs < 1:
+		logger.error("--jobs must be at least 1")
+		return -1
+	if args.timeout is not None and args.timeout <= 0:
+		logger.error("--timeout must be positive")
+		return -1
+	if len(args.source) == 0:
+		parser.print_help()
+		return 0
+	if not os.path.isdir(DUNGEON_PATH):
+		logger.error("Couldn't find dungeon. Set INQUISITOR_DUNGEON or cd to parent folder of ./dungeon")
+		return -1
+	if not os.path.isdir(SOURCES_PATH):
+		logger.error("Couldn't find sources. Set INQUISITOR_SOURCES or cd to parent folder of ./sources")
+
+	from inquisitor.daemon import run_daemon
+	run_daemon(args.source, jobs=args.jobs, timeout=args.timeout)
 	return 0
 
 
@@ -88,26 +176,146 @@ def command_deactivate(args):
 		return -1
 
 	# Deactivate all items in each source.
-	from inquisitor.loader import load_items
+	from inquisitor.loader import batch, cell_exists, iter_items
 	for source_name in args.source:
-		path = os.path.join(DUNGEON_PATH, source_name)
-		if not os.path.isdir(path):
+		if not cell_exists(source_name):
 			logger.warning("'{}' is not an extant source".format(source_name))
+			continue
 		count = 0
-		items, _ = load_items(source_name)
-		for item in items.values():
-			if args.tag and args.tag not in item['tags']:
-				continue
-			if args.title and args.title not in item['title']:
-				continue
-			if item['active']:
-				item['active'] = False
-				count += 1
+		with batch():
+			for item, error in iter_items([source_name]):
+				if error:
+					logger.warning("Could not read {}".format(error))
+					continue
+				if args.tag and args.tag not in item['tags']:
+					continue
+				if args.title and args.title not in item['title']:
+					continue
+				if item['active']:
+					item['active'] = False
+					count += 1
 		logger.info("Deactivated {} items in '{}'".format(count, source_name))
 
 	return 0
 
 
+def command_reindex(args):
+	"""Rebuild the item manifests of the specified dungeon cells."""
+	parser = argparse.ArgumentParser(
+		prog="inquisitor reindex",
+		description=command_reindex.__doc__,
+		add_help=False)
+	parser.add_argument("source",
+		nargs="*",
+		help="Cells to reindex. Defaults to all cells.")
+	args = parser.parse_args(args)
+
+	if not os.path.isdir(DUNGEON_PATH):
+		logger.error("Couldn't find dungeon. Set INQUISITOR_DUNGEON or cd to parent folder of ./dungeon")
+		return -1
+
+	from inquisitor import loader
+	for source_name in args.source or loader.get_cells():
+		if not loader.cell_exists(source_name):
+			logger.warning("'{}' is not an extant source".format(source_name))
+			continue
+		count, errors = loader.reindex(source_name)
+		for filename in errors:
+			logger.warning("Could not read {}/{}".format(source_name, filename))
+		logger.info("Indexed {} items in '{}'".format(count, source_name))
+
+	return 0
+
+
+def command_gc(args):
+	"""Delete expired items from the specified dungeon cells."""
+	parser = argparse.ArgumentParser(
+		prog="inquisitor gc",
+		description=command_gc.__doc__,
+		add_help=False)
+	parser.add_argument("source",
+		nargs="*",
+		help="Cells to collect. Defaults to all cells.")
+	args = parser.parse_args(args)
+
+	if not os.path.isdir(DUNGEON_PATH):
+		logger.error("Couldn't find dungeon. Set INQUISITOR_DUNGEON or cd to parent folder of ./dungeon")
+		return -1
+
+	from inquisitor import loader, sources
+	for source_name in args.source or loader.get_cells():
+		if not loader.cell_exists(source_name):
+			logger.warning("'{}' is not an extant source".format(source_name))
+			continue
+		count = sources.collect_cell(source_name)
+		logger.info("Deleted {} items from '{}'".format(count, source_name))
+
+	return 0
+
+
+def command_migrate(args):
+	"""Copy the dungeon from one storage backend to another."""
+	from inquisitor.configs.resolver import STORAGE_BACKENDS
+	parser = argparse.ArgumentParser(
+		prog="inquisitor migrate",
+		description=command_migrate.__doc__,
+		add_help=False)
+	parser.add_argument("source_backend",
+		choices=STORAGE_BACKENDS,
+		help="Backend to copy from.")
+	parser.add_argument("dest_backend",
+		choices=STORAGE_BACKENDS,
+		help="Backend to copy to.")
+	args = parser.parse_args(args)
+
+	if args.source_backend == args.dest_backend:
+		logger.error("Cannot migrate a backend to itself")
+		return -1
+	if not os.path.isdir(DUNGEON_PATH):
+		logger.error("Couldn't find dungeon. Set INQUISITOR_DUNGEON or cd to parent folder of ./dungeon")
+		return -1
+
+	from inquisitor.storage import open_storage
+	source_storage = open_storage(args.source_backend)
+	dest_storage = open_storage(args.dest_backend)
+	for cell_name in source_storage.get_cells():
+		state, items = source_storage.export_cell(cell_name)
+		count = dest_storage.import_cell(cell_name, state, items)
+		logger.info("Copied {} items in '{}'".format(count, cell_name))
+
+	return 0
+
+
+def command_encode(args):
+	"""Rewrite the items in the specified dungeon cells in an encoding."""
+	from inquisitor.configs.resolver import ITEM_ENCODINGS
+	parser = argparse.ArgumentParser(
+		prog="inquisitor encode",
+		description=command_encode.__doc__,
+		add_help=False)
+	parser.add_argument("encoding",
+		choices=ITEM_ENCODINGS,
+		help="Encoding to use for the cells.")
+	parser.add_argument("source",
+		nargs="*",
+		help="Cells to encode. Defaults to all cells.")
+	args = parser.parse_args(args)
+
+	from inquisitor import loader
+	if not hasattr(loader.storage, 'set_cell_encoding'):
+		logger.error("Item encodings only apply to the files storage backend")
+		return -1
+
+	for source_name in args.source or loader.get_cells():
+		if not loader.cell_exists(source_name):
+			logger.warning("'{}' is not an extant source".format(source_name))
+			continue
+		count = loader.storage.set_cell_encoding(source_name, args.encoding)
+		logger.info("Encoded {} items in '{}' as {}".format(count, source_name, args.encoding))
+
+	return 0
+
+
 def command_add(args):
 	"""Creates an item."""
 	parser = argparse.ArgumentParser(
@@ -136,11 +344,11 @@ def command_add(args):
 		return -1
 
 	source = args.source or 'inquisitor'
-	cell_path = os.path.join(DUNGEON_PATH, source)
+	from inquisitor.loader import cell_exists
 	if args.create:
 		from inquisitor.sources import ensure_cell
 		ensure_cell(source)
-	elif not os.path.isdir(cell_path):
+	elif not cell_exists(source):
 		logger.error("Source '{}' does not exist".format(source))
 		return -1
 
@@ -165,29 +373,68 @@ def command_add(args):
 
 def command_feed(args):
 	"""Print the current feed."""
+	parser = argparse.ArgumentParser(
+		prog="inquisitor feed",
+		description=command_feed.__doc__,
+		add_help=False)
+	parser.add_argument("--json",
+		action="store_true",
+		help="Print each item as a line of JSON")
+	parser.add_argument("--only",
+		help="Only print items with one of these comma-separated tags")
+	parser.add_argument("--not",
+		dest="exclude",
+		help="Do not print items with any of these comma-separated tags")
+	parser.add_argument("--limit",
+		type=int,
+		help="Print at most this many items")
+	parser.add_argument("--after",
+		help="Print the items after this feed cursor")
+	args = parser.parse_args(args)
+
 	if not os.path.isdir(DUNGEON_PATH):
 		logger.error("Couldn't find dungeon. Set INQUISITOR_DUNGEON or cd to parent folder of ./dungeon")
 		return -1
 
 	import shutil
 	from inquisitor import loader
+	from inquisitor import paging
 	from inquisitor import timestamp
 
-	items, errors = loader.load_active_items(source_names=None)
-	if not items and not errors:
-		print("Feed is empty")
+	only = args.only.split(",") if args.only else []
+	exclude = args.exclude.split(",") if args.exclude else []
+	try:
+		after = paging.decode_cursor(args.after) if args.after else None
+	except ValueError as e:
+		logger.error(str(e))
+		return -1
+	entries, _, _, _ = loader.select_entries(None, only, exclude, after, args.limit)
+
+	if args.json:
+		# Items are written as they are read, so the feed can be piped
+		try:
+			for item, error in loader.iter_entries(entries):
+				if error:
+					logger.warning("Could not read {}".format(error))
+					continue
+				sys.stdout.write(json.dumps(item.item) + '\n')
+			sys.stdout.flush()
+		except BrokenPipeError:
+			# The reader went away, so stop quietly
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
 		return 0
 
-	if errors:
-		items.insert(0, {
-			'title': '{} read errors: {}'.format(len(errors), ' '.join(errors)),
-			'body': "\n".join(errors)
-		})
+	if not entries:
+		print("Feed is empty")
+		return 0
 
 	size = shutil.get_terminal_size((80, 20))
 	width = min(80, size.columns)
 
-	for item in items:
+	# Items are printed as they are read
+	for item, error in loader.iter_entries(entries):
+		if error:
+			item = {'title': 'Read error: {}'.format(error)}
 		title = item['title'] if 'title' in item else ""
 		titles = [title]
 		while len(titles[-1]) > width - 4:
@@ -211,6 +458,36 @@ def command_feed(args):
 		print()
 
 
+def command_prune(args):
+	"""Remove cached files that no item refers to."""
+	parser = argparse.ArgumentParser(
+		prog="inquisitor prune",
+		description=command_prune.__doc__,
+		add_help=False)
+	args = parser.parse_args(args)
+
+	if not os.path.isdir(DUNGEON_PATH):
+		logger.error("Couldn't find dungeon. Set INQUISITOR_DUNGEON or cd to parent folder of ./dungeon")
+		return -1
+
+	from inquisitor import loader
+	from inquisitor.filecache import file_cache, find_references
+
+	# Every item in the dungeon counts, active or not, since the files are
+	# needed until the item is deleted
+	referenced = set()
+	for item, error in loader.iter_items(loader.get_cells()):
+		if error:
+			logger.error("Could not read {}, not pruning".format(error))
+			return -1
+		referenced |= find_references(json.dumps(item.item))
+	count = file_cache.prune(referenced)
+	stats = file_cache.stats()
+	logger.info("Removed {} files, {} files in cache ({} bytes)".format(
+		count, stats['files'], stats['bytes']))
+	return 0
+
+
 def command_run(args):
 	"""Run the default Flask server."""
 	parser = argparse.ArgumentParser(
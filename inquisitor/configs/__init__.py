@@ -1,6 +1,23 @@
 from .resolver import data_path as DUNGEON_PATH
 from .resolver import source_path as SOURCES_PATH
 from .resolver import cache_path as CACHE_PATH
+from .resolver import cache_size_limit as CACHE_SIZE_LIMIT
+from .resolver import cache_file_limit as CACHE_FILE_LIMIT
+from .resolver import cache_offload as CACHE_OFFLOAD
+from .resolver import cache_accel_path as CACHE_ACCEL_PATH
+from .resolver import storage_backend as STORAGE_BACKEND
+from .resolver import database_path as DATABASE_PATH
+from .resolver import item_encoding as ITEM_ENCODING
+from .resolver import item_cache_bytes as ITEM_CACHE_BYTES
+from .resolver import scan_threads as SCAN_THREADS
+from .resolver import live_feed as LIVE_FEED
+from .resolver import http_timeout as HTTP_TIMEOUT
+from .resolver import http_retries as HTTP_RETRIES
+from .resolver import http_host_connections as HTTP_HOST_CONNECTIONS
+from .resolver import http_host_interval as HTTP_HOST_INTERVAL
+from .resolver import update_interval as UPDATE_INTERVAL
+from .resolver import update_intervals as UPDATE_INTERVALS
+from .resolver import callback_workers as CALLBACK_WORKERS
 from .resolver import (
 	logger,
 	subfeeds)
@@ -19,6 +19,84 @@ DEFAULT_SOURCES_PATH = '/var/inquisitor/sources/'
 CONFIG_CACHE = 'CachePath'
 DEFAULT_CACHE_PATH = '/var/inquisitor/cache/'
 
+# Total size in bytes of the files downloaded into the cache folder, beyond
+# which the least recently used files are evicted
+CONFIG_CACHE_SIZE = 'CacheSizeLimit'
+DEFAULT_CACHE_SIZE = '1073741824'
+
+# Largest file in bytes that will be downloaded into the cache folder
+CONFIG_CACHE_FILE_SIZE = 'CacheFileLimit'
+DEFAULT_CACHE_FILE_SIZE = '20971520'
+
+# How the web app hands cached files to a front end server instead of sending
+# them itself: "none", "x-sendfile", or "x-accel-redirect"
+CONFIG_CACHE_OFFLOAD = 'CacheOffload'
+DEFAULT_CACHE_OFFLOAD = 'none'
+CACHE_OFFLOADS = ('none', 'x-sendfile', 'x-accel-redirect')
+
+# The internal nginx location that serves the cache folder, for use with
+# X-Accel-Redirect
+CONFIG_CACHE_ACCEL_PATH = 'CacheAccelPath'
+DEFAULT_CACHE_ACCEL_PATH = '/_cache/'
+
+# Storage backend for the dungeon, either "files" or "sqlite"
+CONFIG_STORAGE = 'Storage'
+DEFAULT_STORAGE = 'files'
+STORAGE_BACKENDS = ('files', 'sqlite')
+
+# Path to the database file used by the sqlite storage backend
+CONFIG_DATABASE = 'DatabasePath'
+DEFAULT_DATABASE_FILE = 'inquisitor.db'
+
+# Encoding of item files in the files storage backend, either "json" or
+# "protobuf". Items in either encoding can always be read.
+CONFIG_ITEM_ENCODING = 'ItemEncoding'
+DEFAULT_ITEM_ENCODING = 'json'
+ITEM_ENCODINGS = ('json', 'protobuf')
+
+# Total size in bytes of the item files the web app keeps parsed in memory
+CONFIG_ITEM_CACHE = 'ItemCacheBytes'
+DEFAULT_ITEM_CACHE = '67108864'
+
+# Number of threads used to list cells and read items in the files storage
+# backend, which helps on high-latency file systems
+CONFIG_SCAN_THREADS = 'ScanThreads'
+DEFAULT_SCAN_THREADS = '8'
+
+# Whether the web app follows the dungeon with inotify instead of scanning it
+# on each request
+CONFIG_LIVE_FEED = 'LiveFeed'
+DEFAULT_LIVE_FEED = 'false'
+
+# Seconds to wait on an HTTP request made through the shared session
+CONFIG_HTTP_TIMEOUT = 'HttpTimeout'
+DEFAULT_HTTP_TIMEOUT = '30'
+
+# Number of times a failed HTTP GET is retried, with exponential backoff
+CONFIG_HTTP_RETRIES = 'HttpRetries'
+DEFAULT_HTTP_RETRIES = '3'
+
+# Most HTTP requests in flight to a single host at once
+CONFIG_HTTP_HOST_CONNECTIONS = 'HttpHostConnections'
+DEFAULT_HTTP_HOST_CONNECTIONS = '4'
+
+# Least number of seconds between the starts of HTTP requests to one host
+CONFIG_HTTP_HOST_INTERVAL = 'HttpHostInterval'
+DEFAULT_HTTP_HOST_INTERVAL = '0'
+
+# Seconds between updates of a source by the update daemon
+CONFIG_UPDATE_INTERVAL = 'UpdateInterval'
+DEFAULT_UPDATE_INTERVAL = '3600'
+
+# Update intervals for individual sources, with each source and its interval
+# separated by lines
+CONFIG_UPDATE_INTERVALS = 'UpdateIntervals'
+DEFAULT_UPDATE_INTERVALS = None
+
+# Number of threads in each web app process that run item callbacks
+CONFIG_CALLBACK_WORKERS = 'CallbackWorkers'
+DEFAULT_CALLBACK_WORKERS = '2'
+
 # Path to a log file where logging will be redirected
 CONFIG_LOGFILE = 'LogFile'
 DEFAULT_LOG_FILE = None
@@ -80,6 +158,28 @@ def parse_subfeed_value(value):
 	return subfeeds
 
 
+def parse_interval_value(value):
+	defs = [line.strip() for line in value.split('\n') if line.strip()]
+	intervals = {}
+	for interval_def in defs:
+		if ':' not in interval_def:
+			raise ValueError(f'Invalid update interval definition: {interval_def}')
+		source_name, seconds = interval_def.split(':', maxsplit=1)
+		intervals[source_name.strip()] = parse_seconds(
+			CONFIG_UPDATE_INTERVALS, seconds.strip(), positive=True)
+	return intervals
+
+
+def parse_seconds(key, value, positive=False):
+	try:
+		seconds = float(value)
+	except ValueError:
+		raise ValueError(f'Invalid {key} value: {value}')
+	if seconds < 0 or positive and seconds == 0:
+		raise ValueError(f'Invalid {key} value: {value}')
+	return seconds
+
+
 # Read envvar for config file location, with fallback to default
 config_path = os.path.abspath(
 	os.environ.get(CONFIG_ENVVAR) or
@@ -107,6 +207,88 @@ if not os.path.isabs(cache_path):
 if not os.path.isdir(cache_path):
 	raise FileNotFoundError(f'Cannot find directory {cache_path}')
 
+cache_size_limit = configs.get(CONFIG_CACHE_SIZE) or DEFAULT_CACHE_SIZE
+if not cache_size_limit.isdigit():
+	raise ValueError(f'Invalid cache size limit: {cache_size_limit}')
+cache_size_limit = int(cache_size_limit)
+
+cache_file_limit = configs.get(CONFIG_CACHE_FILE_SIZE) or DEFAULT_CACHE_FILE_SIZE
+if not cache_file_limit.isdigit():
+	raise ValueError(f'Invalid cache file size limit: {cache_file_limit}')
+cache_file_limit = int(cache_file_limit)
+
+cache_offload = configs.get(CONFIG_CACHE_OFFLOAD) or DEFAULT_CACHE_OFFLOAD
+if cache_offload not in CACHE_OFFLOADS:
+	raise ValueError(f'Invalid cache offload (must be one of {", ".join(CACHE_OFFLOADS)}): {cache_offload}')
+
+cache_accel_path = configs.get(CONFIG_CACHE_ACCEL_PATH) or DEFAULT_CACHE_ACCEL_PATH
+if not cache_accel_path.startswith('/'):
+	raise ValueError(f'Non-absolute cache accel path: {cache_accel_path}')
+if not cache_accel_path.endswith('/'):
+	cache_accel_path += '/'
+
+storage_backend = configs.get(CONFIG_STORAGE) or DEFAULT_STORAGE
+if storage_backend not in STORAGE_BACKENDS:
+	raise ValueError(f'Invalid storage backend (must be one of {", ".join(STORAGE_BACKENDS)}): {storage_backend}')
+
+database_path = (
+	configs.get(CONFIG_DATABASE) or
+	os.path.join(data_path, DEFAULT_DATABASE_FILE))
+if not os.path.isabs(database_path):
+	raise ValueError(f'Non-absolute database path: {database_path}')
+
+item_encoding = configs.get(CONFIG_ITEM_ENCODING) or DEFAULT_ITEM_ENCODING
+if item_encoding not in ITEM_ENCODINGS:
+	raise ValueError(f'Invalid item encoding (must be one of {", ".join(ITEM_ENCODINGS)}): {item_encoding}')
+
+item_cache_bytes = configs.get(CONFIG_ITEM_CACHE) or DEFAULT_ITEM_CACHE
+if not item_cache_bytes.isdigit():
+	raise ValueError(f'Invalid item cache size: {item_cache_bytes}')
+item_cache_bytes = int(item_cache_bytes)
+
+scan_threads = configs.get(CONFIG_SCAN_THREADS) or DEFAULT_SCAN_THREADS
+if not scan_threads.isdigit() or int(scan_threads) < 1:
+	raise ValueError(f'Invalid scan thread count: {scan_threads}')
+scan_threads = int(scan_threads)
+
+live_feed = configs.get(CONFIG_LIVE_FEED) or DEFAULT_LIVE_FEED
+if live_feed != 'true' and live_feed != 'false':
+	raise ValueError(f'Invalid live feed value (must be "true" or "false"): {live_feed}')
+live_feed = (live_feed == 'true')
+if live_feed and storage_backend != 'files':
+	raise ValueError('The live feed requires the files storage backend')
+
+http_timeout = parse_seconds(
+	CONFIG_HTTP_TIMEOUT,
+	configs.get(CONFIG_HTTP_TIMEOUT) or DEFAULT_HTTP_TIMEOUT)
+
+http_retries = configs.get(CONFIG_HTTP_RETRIES) or DEFAULT_HTTP_RETRIES
+if not http_retries.isdigit():
+	raise ValueError(f'Invalid HTTP retry count: {http_retries}')
+http_retries = int(http_retries)
+
+http_host_connections = configs.get(CONFIG_HTTP_HOST_CONNECTIONS) or DEFAULT_HTTP_HOST_CONNECTIONS
+if not http_host_connections.isdigit() or int(http_host_connections) < 1:
+	raise ValueError(f'Invalid HTTP host connection count: {http_host_connections}')
+http_host_connections = int(http_host_connections)
+
+http_host_interval = parse_seconds(
+	CONFIG_HTTP_HOST_INTERVAL,
+	configs.get(CONFIG_HTTP_HOST_INTERVAL) or DEFAULT_HTTP_HOST_INTERVAL)
+
+update_interval = parse_seconds(
+	CONFIG_UPDATE_INTERVAL,
+	configs.get(CONFIG_UPDATE_INTERVAL) or DEFAULT_UPDATE_INTERVAL,
+	positive=True)
+
+update_intervals = configs.get(CONFIG_UPDATE_INTERVALS) or DEFAULT_UPDATE_INTERVALS
+update_intervals = parse_interval_value(update_intervals) if update_intervals else {}
+
+callback_workers = configs.get(CONFIG_CALLBACK_WORKERS) or DEFAULT_CALLBACK_WORKERS
+if not callback_workers.isdigit() or int(callback_workers) < 1:
+	raise ValueError(f'Invalid callback worker count: {callback_workers}')
+callback_workers = int(callback_workers)
+
 log_file = configs.get(CONFIG_LOGFILE) or DEFAULT_LOG_FILE
 if log_file and not os.path.isabs(log_file):
 	raise ValueError(f'Non-absolute log file path: {log_file}')
@@ -0,0 +1,122 @@
+"""
+A long-running process that updates sources on a schedule, so that source
+modules and the config are loaded once instead of on every update.
+"""
+# Standard library imports
+import heapq
+import random
+import signal
+import time
+import traceback
+
+# Application imports
+from inquisitor import error, sources
+from inquisitor.configs import UPDATE_INTERVAL, UPDATE_INTERVALS, logger
+
+
+# A source's next update is delayed by up to this fraction of its interval,
+# so that sources with the same interval drift apart.
+JITTER = 0.1
+
+# The longest delay, in seconds, between retries of a failing source, unless
+# its interval is longer.
+MAX_BACKOFF = 24 * 60 * 60
+
+# The shortest delay, in seconds, between updates of a source, so that a
+# tiny interval does not start updates in a busy loop.
+MIN_INTERVAL = 1
+
+
+class UpdateDaemon():
+	"""
+	Updates each of a list of sources every update interval. The interval
+	of a source comes from the UpdateIntervals config, the source module's
+	`update_interval` attribute, or the UpdateInterval config, in that
+	order. Failing sources are retried with exponential backoff.
+	"""
+
+	def __init__(self, source_names, jobs=1, timeout=None):
+		self.source_names = list(dict.fromkeys(source_names))
+		self.pool = sources.UpdatePool(jobs, timeout)
+		# source name -> module last loaded for the source
+		self.modules = {}
+		# source name -> number of consecutive failed updates
+		self.failures = {}
+		# heap of (monotonic time, source name)
+		self.queue = []
+
+	def interval(self, source_name):
+		"""Returns the number of seconds between updates of a source."""
+		if source_name in UPDATE_INTERVALS:
+			return UPDATE_INTERVALS[source_name]
+		module = self.modules.get(source_name)
+		value = getattr(module, 'update_interval', None)
+		if value is None:
+			return UPDATE_INTERVAL
+		try:
+			interval = float(value)
+		except (TypeError, ValueError):
+			interval = 0
+		if interval <= 0:
+			logger.warning(f'Invalid update_interval in "{source_name}": {value}')
+			return UPDATE_INTERVAL
+		return interval
+
+	def schedule(self, source_name, success):
+		"""Schedules the next update of a source after an update ends."""
+		interval = max(self.interval(source_name), MIN_INTERVAL)
+		if success:
+			self.failures[source_name] = 0
+			delay = interval
+		else:
+			failures = self.failures.get(source_name, 0) + 1
+			self.failures[source_name] = failures
+			delay = min(interval * 2 ** failures, max(interval, MAX_BACKOFF))
+		delay += random.uniform(0, JITTER * delay)
+		logger.debug(f'Next update of "{source_name}" in {delay:.0f} seconds')
+		heapq.heappush(self.queue, (time.monotonic() + delay, source_name))
+
+	def start_due(self):
+		"""Starts the updates that are due, as far as the job limit allows."""
+		now = time.monotonic()
+		while self.queue and self.queue[0][0] <= now and not self.pool.full():
+			_, source_name = heapq.heappop(self.queue)
+			try:
+				module = sources.load_source(source_name)
+			except Exception:
+				error.as_item(
+					f'Error importing source "{source_name}"',
+					traceback.format_exc())
+				self.schedule(source_name, False)
+				continue
+			self.modules[source_name] = module
+			self.pool.start(source_name, module)
+
+	def run(self):
+		"""Updates the sources until the process is interrupted or terminated."""
+		logger.info(f'Scheduling {len(self.source_names)} sources')
+		now = time.monotonic()
+		for source_name in self.source_names:
+			heapq.heappush(self.queue, (now, source_name))
+		try:
+			while True:
+				self.start_due()
+				# A full pool waits for an update to end instead
+				until = self.queue[0][0] if self.queue and not self.pool.full() else None
+				for source_name, success in self.pool.wait(until):
+					self.schedule(source_name, success)
+		except KeyboardInterrupt:
+			logger.info('Stopping')
+		finally:
+			self.pool.stop()
+
+
+def run_daemon(source_names, jobs=1, timeout=None):
+	"""
+	Updates the given sources on their schedules until interrupted.
+	"""
+	# Stop on SIGTERM the same way as on SIGINT
+	def terminate(signum, frame):
+		raise KeyboardInterrupt()
+	signal.signal(signal.SIGTERM, terminate)
+	UpdateDaemon(source_names, jobs, timeout).run()
@@ -1,10 +1,9 @@
-import os
 import logging
 import json
 import random
 
-from inquisitor import timestamp
-from inquisitor.configs import DUNGEON_PATH, logger
+from inquisitor import timestamp, loader
+from inquisitor.configs import logger
 
 logger = logging.getLogger("inquisitor")
 
@@ -20,7 +19,5 @@ def as_item(title, body=None):
 	}
 	if body is not None:
 		item['body'] = '<pre>{}</pre>'.format(body)
-	path = os.path.join(DUNGEON_PATH, 'inquisitor', iid + ".item")
 	logger.error(json.dumps(item))
-	with open(path, 'w') as f:
-		f.write(json.dumps(item, indent=2))
+	loader.new_item('inquisitor', item)
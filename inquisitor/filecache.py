@@ -0,0 +1,228 @@
+"""
+A content-addressed cache of downloaded files, such as the images in item
+bodies. Files are stored under the hash of their contents, so a file
+downloaded from several URLs is only stored once, and an index records
+which file each URL gave so that known URLs are revalidated instead of
+downloaded again.
+"""
+# Standard library imports
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Application imports
+from inquisitor.configs import CACHE_PATH, CACHE_SIZE_LIMIT, CACHE_FILE_LIMIT, logger
+from inquisitor.sessions import session
+
+
+INDEX_FILE = 'cache.db'
+OBJECTS_DIR = 'objects'
+TEMP_DIR = 'tmp'
+
+# Known URLs are reused without a request until they are this old, in
+# seconds, and revalidated with a conditional request after that.
+REVALIDATE_AFTER = 24 * 60 * 60
+
+# Pruning keeps unreferenced files this new, in seconds, since the items
+# that refer to them may not have been written yet.
+PRUNE_GRACE = 60 * 60
+
+# References to cached files in items
+CACHED_FILE_URL = re.compile(r'/cache/(objects/[0-9a-f]{2}/[0-9a-f]{64}[\w.]*)')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+	url TEXT PRIMARY KEY,
+	path TEXT NOT NULL,
+	etag TEXT,
+	last_modified TEXT,
+	checked NUMERIC NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+	path TEXT PRIMARY KEY,
+	size INTEGER NOT NULL,
+	used NUMERIC NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_used ON files (used);
+"""
+
+
+class FileCache():
+	"""
+	Downloads files into a cache folder and serves repeat requests for the
+	same URL from it. The total size of the cache is kept under a budget by
+	evicting the least recently used files.
+	"""
+
+	def __init__(self, path, size_limit, file_limit):
+		self.path = path
+		self.size_limit = size_limit
+		self.file_limit = file_limit
+		self.local = threading.local()
+		# A forked process opens its own connection
+		os.register_at_fork(after_in_child=self.forget_connection)
+
+	def forget_connection(self):
+		self.local = threading.local()
+
+	@property
+	def db(self):
+		"""The calling thread's connection to the cache index."""
+		if not hasattr(self.local, 'db'):
+			db = sqlite3.connect(os.path.join(self.path, INDEX_FILE), timeout=30)
+			db.execute('PRAGMA journal_mode=WAL')
+			db.executescript(SCHEMA)
+			self.local.db = db
+		return self.local.db
+
+	def exists(self, path):
+		return os.path.isfile(os.path.join(self.path, path))
+
+	def fetch(self, url, ext=''):
+		"""
+		Returns the path within the cache folder of the file at a URL,
+		downloading it if it is not already cached. `ext` is the extension
+		given to a newly cached file.
+		"""
+		now = time.time()
+		row = self.db.execute(
+			'SELECT path, etag, last_modified, checked FROM urls WHERE url = ?',
+			(url,)).fetchone()
+		headers = {}
+		if row and self.exists(row[0]):
+			path, etag, last_modified, checked = row
+			if now - checked < REVALIDATE_AFTER:
+				self.touch(path, now)
+				return path
+			if etag:
+				headers['If-None-Match'] = etag
+			if last_modified:
+				headers['If-Modified-Since'] = last_modified
+		else:
+			row = None
+
+		logger.info(f'Caching {url}')
+		with session.get(url, headers=headers, stream=True) as response:
+			etag = response.headers.get('ETag')
+			last_modified = response.headers.get('Last-Modified')
+			if row and response.status_code == 304:
+				# A 304 need not repeat the validators, so keep the stored ones
+				path = row[0]
+				etag = etag or row[1]
+				last_modified = last_modified or row[2]
+			else:
+				response.raise_for_status()
+				path = self.store(url, response, ext)
+			with self.db as db:
+				db.execute(
+					'INSERT OR REPLACE INTO urls (url, path, etag, last_modified, checked)'
+					' VALUES (?, ?, ?, ?, ?)',
+					(url, path, etag, last_modified, now))
+		self.touch(path, now)
+		self.evict(keep=path)
+		return path
+
+	def store(self, url, response, ext):
+		"""
+		Streams a response body into the cache and returns its path. Raises
+		ValueError if it is larger than the file size limit.
+		"""
+		length = response.headers.get('Content-Length')
+		if length and length.isdigit() and int(length) > self.file_limit:
+			raise ValueError(f'{url} is larger than {self.file_limit} bytes')
+		temp_path = os.path.join(self.path, TEMP_DIR)
+		os.makedirs(temp_path, exist_ok=True)
+		digest = hashlib.sha256()
+		size = 0
+		fd, temp_file = tempfile.mkstemp(dir=temp_path)
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				for chunk in response.iter_content(chunk_size=1 << 16):
+					size += len(chunk)
+					if size > self.file_limit:
+						raise ValueError(f'{url} is larger than {self.file_limit} bytes')
+					digest.update(chunk)
+					f.write(chunk)
+			name = digest.hexdigest()
+			path = os.path.join(OBJECTS_DIR, name[:2], name + ext)
+			full_path = os.path.join(self.path, path)
+			os.makedirs(os.path.dirname(full_path), exist_ok=True)
+			# Identical content is already stored under the same name
+			os.replace(temp_file, full_path)
+		except BaseException:
+			os.remove(temp_file)
+			raise
+		with self.db as db:
+			db.execute(
+				'INSERT OR REPLACE INTO files (path, size, used) VALUES (?, ?, ?)',
+				(path, size, time.time()))
+		return path
+
+	def touch(self, path, now):
+		with self.db as db:
+			db.execute('UPDATE files SET used = ? WHERE path = ?', (now, path))
+
+	def remove(self, db, path):
+		try:
+			os.remove(os.path.join(self.path, path))
+		except FileNotFoundError:
+			pass
+		db.execute('DELETE FROM files WHERE path = ?', (path,))
+		db.execute('DELETE FROM urls WHERE path = ?', (path,))
+
+	def evict(self, keep=None):
+		"""
+		Removes the least recently used files until the cache is within its
+		size budget. Returns the number of files removed.
+		"""
+		total, = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()
+		if total <= self.size_limit:
+			return 0
+		count = 0
+		with self.db as db:
+			rows = db.execute('SELECT path, size FROM files ORDER BY used').fetchall()
+			for path, size in rows:
+				if total <= self.size_limit:
+					break
+				if path == keep:
+					continue
+				self.remove(db, path)
+				total -= size
+				count += 1
+		logger.debug(f'Evicted {count} files from the cache')
+		return count
+
+	def prune(self, referenced):
+		"""
+		Removes the files not in `referenced` that were not used recently,
+		then enforces the size budget. Returns the number of files removed.
+		"""
+		cutoff = time.time() - PRUNE_GRACE
+		count = 0
+		with self.db as db:
+			rows = db.execute(
+				'SELECT path FROM files WHERE used < ?', (cutoff,)).fetchall()
+			for path, in rows:
+				if path not in referenced:
+					self.remove(db, path)
+					count += 1
+		return count + self.evict()
+
+	def stats(self):
+		"""Returns the number and total size of the cached files."""
+		files, size = self.db.execute(
+			'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files').fetchone()
+		return {'files': files, 'bytes': size, 'max_bytes': self.size_limit}
+
+
+def find_references(text):
+	"""Returns the cached file paths referred to in some text."""
+	return set(CACHED_FILE_URL.findall(text))
+
+
+# The cache folder in the config file
+file_cache = FileCache(CACHE_PATH, CACHE_SIZE_LIMIT, CACHE_FILE_LIMIT)
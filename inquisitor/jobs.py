@@ -0,0 +1,209 @@
+"""
+A persistent queue of item callbacks. Callbacks are run in the background
+by worker threads, so that a web request does not wait for a callback to
+finish, and their status is kept so the feed page can poll for it.
+"""
+# Standard library imports
+import os
+import random
+import sqlite3
+import threading
+import time
+
+# Application imports
+from inquisitor.configs import DUNGEON_PATH, CALLBACK_WORKERS, logger
+from inquisitor import sources
+
+
+QUEUE_FILE = 'jobs.db'
+
+# Finished jobs are kept this long, in seconds, so that their status can
+# still be requested.
+KEEP_FINISHED = 24 * 60 * 60
+
+# Idle workers check this often, in seconds, for jobs queued by other
+# processes.
+POLL_INTERVAL = 5
+
+# A job is pending until a worker takes it, then running until it is done
+# or has failed. At most one job for an item is pending at a time.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+	id TEXT PRIMARY KEY,
+	source TEXT NOT NULL,
+	itemid TEXT NOT NULL,
+	status TEXT NOT NULL,
+	pid INTEGER,
+	created NUMERIC NOT NULL,
+	finished NUMERIC
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_pending ON jobs (source, itemid) WHERE status = 'pending';
+"""
+
+
+def pid_exists(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+
+class JobQueue():
+	"""
+	Queues item callbacks in a database shared by every process using the
+	same dungeon, and runs them on a pool of worker threads in each process
+	that starts the queue. Jobs for the same source are run one at a time,
+	so that callbacks do not write over each other's changes to the
+	source's state.
+	"""
+
+	def __init__(self, path, workers):
+		self.path = path
+		self.workers = workers
+		self.local = threading.local()
+		self.wake = threading.Condition()
+		self.start_lock = threading.Lock()
+		# The process that started the workers, since threads do not
+		# survive a fork
+		self.started = None
+		# A forked process opens its own connection
+		os.register_at_fork(after_in_child=self.forget_connection)
+
+	def forget_connection(self):
+		self.local = threading.local()
+
+	@property
+	def db(self):
+		"""The calling thread's connection to the queue."""
+		if not hasattr(self.local, 'db'):
+			db = sqlite3.connect(os.path.join(self.path, QUEUE_FILE), timeout=30)
+			db.execute('PRAGMA journal_mode=WAL')
+			db.executescript(SCHEMA)
+			self.local.db = db
+		return self.local.db
+
+	def submit(self, source_name, itemid):
+		"""
+		Queues a callback on an item and returns the id of its job. If a
+		callback on the item is already pending, that job's id is returned.
+		"""
+		self.start()
+		job_id = '{:x}'.format(random.getrandbits(16 * 4))
+		with self.db as db:
+			db.execute(
+				"INSERT OR IGNORE INTO jobs (id, source, itemid, status, created)"
+				" VALUES (?, ?, ?, 'pending', ?)",
+				(job_id, source_name, itemid, time.time()))
+			job_id, = db.execute(
+				"SELECT id FROM jobs WHERE source = ? AND itemid = ? AND status = 'pending'",
+				(source_name, itemid)).fetchone()
+		with self.wake:
+			self.wake.notify()
+		return job_id
+
+	def status(self, job_id):
+		"""Returns the status of a job, or None if there is no such job."""
+		self.start()
+		row = self.db.execute(
+			'SELECT id, source, itemid, status FROM jobs WHERE id = ?',
+			(job_id,)).fetchone()
+		if row is None:
+			return None
+		return dict(zip(('id', 'source', 'itemid', 'status'), row))
+
+	def claim(self):
+		"""
+		Marks the oldest pending job whose source has no running job as
+		running, and returns its id, source and item id, or None.
+		"""
+		db = self.db
+		db.execute('BEGIN IMMEDIATE')
+		try:
+			job = db.execute(
+				"SELECT id, source, itemid FROM jobs"
+				" WHERE status = 'pending'"
+				" AND source NOT IN (SELECT source FROM jobs WHERE status = 'running')"
+				" ORDER BY created LIMIT 1").fetchone()
+			if job:
+				db.execute(
+					"UPDATE jobs SET status = 'running', pid = ? WHERE id = ?",
+					(os.getpid(), job[0]))
+			db.commit()
+		except BaseException:
+			db.rollback()
+			raise
+		return job
+
+	def finish(self, job_id, success):
+		"""Records the outcome of a job and forgets old finished jobs."""
+		now = time.time()
+		with self.db as db:
+			db.execute(
+				'UPDATE jobs SET status = ?, finished = ? WHERE id = ?',
+				('done' if success else 'failed', now, job_id))
+			db.execute(
+				"DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?",
+				(now - KEEP_FINISHED,))
+		# A job waiting on this job's source may run now
+		with self.wake:
+			self.wake.notify_all()
+
+	def recover(self):
+		"""
+		Queues again the jobs left running by processes that have exited,
+		unless the same callback is already pending.
+		"""
+		with self.db as db:
+			pids = [pid for pid, in db.execute(
+				"SELECT DISTINCT pid FROM jobs WHERE status = 'running'")]
+			for pid in pids:
+				if pid_exists(pid):
+					continue
+				db.execute(
+					"DELETE FROM jobs AS stale WHERE status = 'running' AND pid = ? AND EXISTS"
+					" (SELECT 1 FROM jobs WHERE status = 'pending' AND source = stale.source AND itemid = stale.itemid)",
+					(pid,))
+				count = db.execute(
+					"UPDATE jobs SET status = 'pending', pid = NULL WHERE status = 'running' AND pid = ?",
+					(pid,)).rowcount
+				if count:
+					logger.info(f'Requeued {count} interrupted callbacks')
+
+	def start(self):
+		"""Starts the worker threads in this process, if they are not running."""
+		with self.start_lock:
+			if self.started == os.getpid():
+				return
+			self.started = os.getpid()
+			self.recover()
+			for i in range(self.workers):
+				threading.Thread(
+					target=self.work,
+					name=f'callback-{i}',
+					daemon=True).start()
+
+	def work(self):
+		while True:
+			# Jobs are claimed under the condition, so a job submitted after
+			# an empty claim wakes the worker.
+			with self.wake:
+				try:
+					job = self.claim()
+				except sqlite3.Error as e:
+					logger.warning(f'Could not check for callbacks: {e}')
+					job = None
+				if job is None:
+					self.wake.wait(POLL_INTERVAL)
+					continue
+			job_id, source_name, itemid = job
+			logger.info(f'Executing callback for {source_name}/{itemid}')
+			success = sources.item_callback(source_name, itemid)
+			self.finish(job_id, success)
+
+
+# The callback queue kept in the dungeon in the config file
+job_queue = JobQueue(DUNGEON_PATH, CALLBACK_WORKERS)
@@ -0,0 +1,301 @@
+"""
+An in-memory view of the feed that follows changes to the dungeon through
+Linux inotify events.
+"""
+# Standard library imports
+import bisect
+import ctypes
+import ctypes.util
+import heapq
+import os
+import struct
+import threading
+
+# Application imports
+from inquisitor.configs import logger
+from inquisitor.storage.files import manifest_entry
+from inquisitor.storage.index import show_time
+from inquisitor.paging import position
+from inquisitor import timestamp
+
+
+# inotify flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+DUNGEON_MASK = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+CELL_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_ONLYDIR
+
+
+class Inotify():
+	"""A minimal wrapper around the Linux inotify API."""
+
+	def __init__(self):
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.add = libc.inotify_add_watch
+		self.add.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+		self.rm = libc.inotify_rm_watch
+		self.rm.argtypes = (ctypes.c_int, ctypes.c_int)
+		self.fd = libc.inotify_init1(IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+	def add_watch(self, path, mask):
+		wd = self.add(self.fd, os.fsencode(path), mask)
+		if wd < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno), path)
+		return wd
+
+	def read_events(self):
+		"""Blocks until events arrive and returns (wd, mask, name) tuples."""
+		data = os.read(self.fd, 1 << 16)
+		events = []
+		offset = 0
+		while offset < len(data):
+			wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+			name = data[offset:offset + length].rstrip(b'\0')
+			offset += length
+			events.append((wd, mask, os.fsdecode(name)))
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+
+class LiveFeed():
+	"""
+	A materialized view of the visible active items in the dungeon, sorted
+	by time. Items hidden by a time-to-show are held until they are due.
+	The view is updated from inotify events as items are written and
+	deleted, including by other processes, and rebuilt from the manifests
+	if the event queue overflows.
+	"""
+
+	def __init__(self, storage):
+		self.storage = storage
+		self.lock = threading.Lock()
+		self.ready = threading.Event()
+		# Set if the view stopped following the dungeon and can't be trusted
+		self.error = None
+		self.failed = False
+		self.cells = {}
+		self.clear()
+
+	def clear(self):
+		# (source, id) -> manifest entry of each visible item
+		self.entries = {}
+		# (sort key, source, id) of each visible item, sorted
+		self.order = []
+		# Heap of (show time, source, id) and the entries hidden by tts
+		self.hidden = []
+		self.hidden_entries = {}
+		# Item and tag counts of the visible items in each source
+		self.source_counts = {}
+		self.tag_counts = {}
+
+	def start(self):
+		"""Starts following the dungeon in a background thread."""
+		self.inotify = Inotify()
+		thread = threading.Thread(target=self.run, name='livefeed', daemon=True)
+		thread.start()
+		self.ready.wait()
+		if self.error is not None:
+			self.inotify.close()
+			raise self.error
+
+	def run(self):
+		try:
+			self.rescan()
+		except Exception as e:
+			self.error = e
+			return
+		finally:
+			self.ready.set()
+		while True:
+			try:
+				events = self.inotify.read_events()
+				if any(mask & IN_Q_OVERFLOW for _, mask, _ in events):
+					logger.warning('inotify queue overflowed, rescanning the dungeon')
+					self.rescan()
+					continue
+				with self.lock:
+					for wd, mask, name in events:
+						self.handle_event(wd, mask, name)
+			except InterruptedError:
+				continue
+			except Exception as e:
+				logger.error(f'The live feed stopped following the dungeon: {e}')
+				self.failed = True
+				self.inotify.close()
+				return
+
+	def watch_cell(self, cell_name):
+		try:
+			wd = self.inotify.add_watch(self.storage.cell_path(cell_name), CELL_MASK)
+			self.cells[wd] = cell_name
+		except OSError as e:
+			logger.warning(f'Could not watch cell {cell_name}: {e}')
+
+	def rescan(self):
+		"""Rebuilds the view from the cell manifests."""
+		self.inotify.add_watch(self.storage.path, DUNGEON_MASK)
+		for cell_name in self.storage.get_cells():
+			self.watch_cell(cell_name)
+		now = timestamp.now()
+		with self.lock:
+			self.clear()
+			for cell_name in set(self.cells.values()):
+				for entry in self.storage.load_manifest(cell_name).values():
+					self.put({**entry, 'source': cell_name}, now)
+		logger.debug(f'Live feed holds {len(self.entries)} items')
+
+	def handle_event(self, wd, mask, name):
+		if wd not in self.cells:
+			# A new cell in the dungeon. Items written to it before the watch
+			# was added have no events, so the cell is read once watched.
+			# Items with events as well are only put twice.
+			if mask & IN_ISDIR and name:
+				self.watch_cell(name)
+				self.load_cell(name)
+			return
+		cell_name = self.cells[wd]
+		if mask & (IN_DELETE_SELF | IN_IGNORED):
+			del self.cells[wd]
+			for source, item_id in list(self.entries) + list(self.hidden_entries):
+				if source == cell_name:
+					self.remove(source, item_id)
+			return
+		if not name.endswith('.item'):
+			return
+		item_id = name[:-5]
+		if mask & (IN_DELETE | IN_MOVED_FROM):
+			self.remove(cell_name, item_id)
+		else:
+			self.load(cell_name, item_id)
+
+	def load_cell(self, cell_name):
+		try:
+			item_ids = self.storage.get_item_ids(cell_name)
+		except FileNotFoundError:
+			return
+		for item_id in item_ids:
+			self.load(cell_name, item_id)
+
+	def load(self, source_name, item_id):
+		try:
+			item = self.storage.load_item(source_name, item_id)
+		except FileNotFoundError:
+			self.remove(source_name, item_id)
+			return
+		except Exception:
+			logger.warning(f'Live feed could not read {source_name}/{item_id}')
+			return
+		self.put({**manifest_entry(item), 'source': source_name}, timestamp.now())
+
+	def refresh(self, source_name, item_id):
+		"""
+		Reloads an item that was just written, without waiting for its
+		inotify event.
+		"""
+		with self.lock:
+			self.load(source_name, item_id)
+
+	def put(self, entry, now):
+		key = (entry['source'], entry['id'])
+		self.remove(*key)
+		if not entry['active']:
+			return
+		# The time-to-show field hides items until an expiry date.
+		shows = show_time(entry)
+		if shows is not None and now < shows:
+			self.hidden_entries[key] = entry
+			heapq.heappush(self.hidden, (shows, *key))
+			return
+		self.entries[key] = entry
+		bisect.insort(self.order, position(entry))
+		source, _ = key
+		self.source_counts[source] = self.source_counts.get(source, 0) + 1
+		counts = self.tag_counts.setdefault(source, {})
+		for tag in entry['tags']:
+			counts[tag] = counts.get(tag, 0) + 1
+
+	def remove(self, source_name, item_id):
+		key = (source_name, item_id)
+		self.hidden_entries.pop(key, None)
+		entry = self.entries.pop(key, None)
+		if entry is None:
+			return
+		index = bisect.bisect_left(self.order, position(entry))
+		del self.order[index]
+		self.source_counts[source_name] -= 1
+		counts = self.tag_counts[source_name]
+		for tag in entry['tags']:
+			counts[tag] -= 1
+			if not counts[tag]:
+				del counts[tag]
+
+	def reveal(self, now):
+		"""Moves hidden items whose time-to-show has passed into the view."""
+		while self.hidden and self.hidden[0][0] <= now:
+			shows, source, item_id = heapq.heappop(self.hidden)
+			entry = self.hidden_entries.get((source, item_id))
+			# Pairs left by items that were removed or hidden again are stale
+			if entry is not None and show_time(entry) == shows:
+				del self.hidden_entries[(source, item_id)]
+				self.put(entry, now)
+
+	def select(self, source_names, wl, bl, after, limit):
+		"""
+		Returns the first `limit` visible items after the position `after`
+		from the given sources that have a tag in `wl`, if it is not empty,
+		and no tag in `bl`, the number of items that pass the filters, the
+		total number of items, and the count of each tag among them. If
+		`limit` is None, all of the items after `after` are returned.
+		"""
+		with self.lock:
+			self.reveal(timestamp.now())
+			sources = set(source_names) if source_names is not None else None
+			only, exclude = set(wl), set(bl)
+			total = 0
+			active_tags = {}
+			for source, count in self.source_counts.items():
+				if sources is not None and source not in sources:
+					continue
+				total += count
+				for tag, tag_count in self.tag_counts[source].items():
+					active_tags[tag] = active_tags.get(tag, 0) + tag_count
+			page = []
+			count = 0
+			start = bisect.bisect_right(self.order, after) if after is not None else 0
+			if not only and not exclude:
+				# Without filters, every item is counted in the total
+				for index in range(start, len(self.order)):
+					if limit is not None and len(page) >= limit:
+						break
+					_, source, item_id = self.order[index]
+					if sources is None or source in sources:
+						page.append(self.entries[(source, item_id)])
+				return page, total, total, active_tags
+			for index, (_, source, item_id) in enumerate(self.order):
+				if sources is not None and source not in sources:
+					continue
+				entry = self.entries[(source, item_id)]
+				tags = set(entry['tags'])
+				if only and not tags & only or tags & exclude:
+					continue
+				count += 1
+				if index >= start and (limit is None or len(page) < limit):
+					page.append(entry)
+			return page, count, total, active_tags
@@ -1,98 +1,87 @@
-import os
-import json
+from inquisitor.configs import STORAGE_BACKEND, logger
+from inquisitor import paging, timestamp
+from inquisitor.storage import open_storage, WritethroughDict, Batch
 
 
-from inquisitor.configs import DUNGEON_PATH, logger
-from inquisitor import error
-from inquisitor import timestamp
+# The dungeon storage selected in the config file
+storage = open_storage(STORAGE_BACKEND)
 
 
-class WritethroughDict():
-	"""A wrapper for a dictionary saved to the file system."""
+def batch():
+	"""
+	Returns a context manager that collects writes to items and states so
+	that each one changed within it is written once when it exits.
+	"""
+	return Batch(storage.transaction)
 
-	@staticmethod
-	def create(path, item):
-		"""
-		Creates a writethrough dictionary from a dictionary in memory and
-		initializes a file to save it.
-		"""
-		if os.path.isfile(path):
-			raise FileExistsError(path)
-		wd = WritethroughDict(path, item)
-		wd.flush()
-		return wd
 
-	@staticmethod
-	def load(path):
-		"""
-		Creates a writethrough dictionary from an existing file in the
-		file system.
-		"""
-		if not os.path.isfile(path):
-			raise FileNotFoundError(path)
-		with open(path) as f:
-			item = json.load(f)
-		return WritethroughDict(path, item)
+def lock_cells(cell_names):
+	"""
+	Returns a context manager that holds the update locks of the given
+	cells, so that other processes updating them wait for it to exit.
+	"""
+	return storage.lock_cells(cell_names)
 
-	def __init__(self, path, item):
-		self.path = path
-		self.item = item
 
-	def __getitem__(self, key):
-		return self.item[key]
+def enable_item_cache(max_bytes):
+	"""
+	Caches parsed items in memory for long-running processes.
+	"""
+	storage.enable_cache(max_bytes)
+
 
-	def get(self, *args, **kwargs):
-		return self.item.get(*args, **kwargs)
+def cache_stats():
+	"""Returns the item cache counters, or None if there is no cache."""
+	return storage.cache_stats()
 
-	def __setitem__(self, key, value):
-		self.item[key] = value
-		self.flush()
 
-	def __contains__(self, key):
-		return key in self.item
+def get_cells():
+	"""Returns a list of the names of the cells in the dungeon."""
+	return storage.get_cells()
 
-	def __repr__(self):
-		return repr(self.item)
 
-	def __str__(self):
-		return str(self.item)
+def cell_exists(cell_name):
+	"""Checks for the existence of a cell."""
+	return storage.cell_exists(cell_name)
 
-	def flush(self):
-		s = json.dumps(self.item, indent=2)
-		with open(self.path, 'w', encoding="utf8") as f:
-			f.write(s)
+
+def ensure_cell(cell_name):
+	"""
+	Creates a cell in the dungeon. Idempotent.
+	"""
+	storage.ensure_cell(cell_name)
 
 
 def load_state(source_name):
 	"""Loads the state dictionary for a source."""
-	state_path = os.path.join(DUNGEON_PATH, source_name, "state")
-	return WritethroughDict.load(state_path)
+	return storage.load_state(source_name)
 
 
 def load_item(source_name, item_id):
 	"""Loads an item from a source."""
-	item_path = os.path.join(DUNGEON_PATH, source_name, f'{item_id}.item')
-	return WritethroughDict.load(item_path)
+	return storage.load_item(source_name, item_id)
 
 
 def item_exists(source_name, item_id):
 	"""
 	Checks for the existence of an item.
 	"""
-	item_path = os.path.join(DUNGEON_PATH, source_name, f'{item_id}.item')
-	return os.path.isfile(item_path)
+	return storage.item_exists(source_name, item_id)
 
 
 def get_item_ids(cell_name):
 	"""
 	Returns a list of item ids in the given cell.
 	"""
-	cell_path = os.path.join(DUNGEON_PATH, cell_name)
-	return [
-		filename[:-5]
-		for filename in os.listdir(cell_path)
-		if filename.endswith('.item')
-	]
+	return storage.get_item_ids(cell_name)
+
+
+def load_manifest(cell_name):
+	"""
+	Returns a map of the ids of the items in a cell to their manifest
+	entries, which include the digest of their updatable fields.
+	"""
+	return storage.load_manifest(cell_name)
 
 
 def new_item(source_name, item):
@@ -124,33 +113,101 @@ def new_item(source_name, item):
 		item['tags'] = [source_name]
 
 	# All other fields are optional.
-	item_path = os.path.join(DUNGEON_PATH, item['source'], f'{item["id"]}.item')
-	return WritethroughDict.create(item_path, item)
+	return storage.create_item(item)
 
 
 def delete_item(source_name, item_id):
 	"""
 	Delete an item.
 	"""
-	item_path = os.path.join(DUNGEON_PATH, source_name, f'{item_id}.item')
-	os.remove(item_path)
+	storage.delete_item(source_name, item_id)
 
 
 def load_items(source_name):
 	"""
 	Returns a map of ids to items and a list of unreadable files.
 	"""
-	cell_path = os.path.join(DUNGEON_PATH, source_name)
-	items = {}
-	errors = []
-	for filename in os.listdir(cell_path):
-		if filename.endswith('.item'):
-			try:
-				item = load_item(source_name, filename[:-5])
-				items[item['id']] = item
-			except Exception:
-				errors.append(filename)
-	return items, errors
+	return storage.load_items(source_name)
+
+
+def reindex(cell_name):
+	"""
+	Rebuilds the indexes of a cell. Returns the number of items indexed and
+	a list of unreadable items.
+	"""
+	return storage.reindex(cell_name)
+
+
+def existing_cells(source_names):
+	"""
+	Returns the names in `source_names` that are cells in the dungeon, or
+	all cells if `source_names` is not defined.
+	"""
+	cells = set(get_cells())
+	check_list = []
+	for source_name in source_names or cells:
+		if source_name not in cells:
+			logger.warning(f'Skipping nonexistent source {source_name}')
+			continue
+		check_list.append(source_name)
+	return check_list
+
+
+def load_active_entries(source_names):
+	"""
+	Returns a list of manifest entries for active items. If `source_names`
+	is defined, load only from sources in that list. Each entry is given
+	the name of its source.
+	"""
+	return storage.load_active_entries(existing_cells(source_names), timestamp.now())
+
+
+def query_entries(source_names, only, exclude):
+	"""
+	Returns the manifest entries for active items that have one of the tags
+	in `only`, if it is not empty, and none of the tags in `exclude`. Also
+	returns the number of active items and the count of each tag among
+	them, taken from the tag index.
+	"""
+	return storage.query_entries(
+		existing_cells(source_names), set(only), set(exclude), timestamp.now())
+
+
+def select_entries(source_names, only, exclude, after, limit):
+	"""
+	Returns the first `limit` manifest entries in feed order after the
+	position `after` that pass the tag filters, the number of entries that
+	pass the filters, the total number of active items, and the count of
+	each tag among them. If `limit` is None, all of the entries after
+	`after` are returned.
+	"""
+	entries, total, active_tags = query_entries(source_names, only, exclude)
+	page = paging.top_k(entries, after, limit)
+	return page, len(entries), total, active_tags
+
+
+def load_entries(entries):
+	"""
+	Returns a list of the items described by the given manifest entries and
+	a list of unreadable items.
+	"""
+	return storage.load_entries(entries)
+
+
+def iter_items(cell_names):
+	"""
+	Yields an (item, error) pair for each item in the given cells, where
+	error is None or the name of an unreadable item.
+	"""
+	return storage.iter_items(list(cell_names))
+
+
+def iter_entries(entries):
+	"""
+	Yields an (item, error) pair for each of the given manifest entries,
+	where error is None or the name of an unreadable item.
+	"""
+	return storage.iter_entries(entries)
 
 
 def load_active_items(source_names):
@@ -158,29 +215,47 @@ def load_active_items(source_names):
 	Returns a list of active items and a list of unreadable items. If
 	`source_names` is defined, load only from sources in that list.
 	"""
-	items = []
-	errors = []
-	now = timestamp.now()
-	check_list = source_names or os.listdir(DUNGEON_PATH)
-	for source_name in check_list:
-		source_path = os.path.join(DUNGEON_PATH, source_name)
-		if not os.path.isdir(source_path):
-			logger.warning(f'Skipping nonexistent source {source_name}')
-			continue
-		for filename in os.listdir(source_path):
-			if not filename.endswith('.item'):
-				continue
-			try:
-				item = load_item(source_name, filename[:-5])
-				# The time-to-show field hides items until an expiry date.
-				if 'tts' in item:
-					tts_date = item['created'] + item['tts']
-					if now < tts_date:
-						continue
-				# Don't show inactive items
-				if not item['active']:
-					continue
-				items.append(item)
-			except Exception:
-				errors.append(filename)
-	return items, errors
+	return load_entries(load_active_entries(source_names))
+
+
+def generation():
+	"""
+	Returns the dungeon's generation counter, which changes whenever an item
+	is created, changed or deleted, and the time it last changed.
+	"""
+	return storage.generation()
+
+
+def reveal_times(source_names):
+	"""
+	Returns the latest time an active item in the given sources was revealed
+	by its time-to-show passing, and the next time one will be, or None for
+	either if there is none.
+	"""
+	return storage.reveal_times(existing_cells(source_names), timestamp.now())
+
+
+def deactivate_items(item_keys):
+	"""
+	Deactivates the items with the given (source, id) keys. Returns the
+	number of items that were active.
+	"""
+	with batch():
+		return storage.deactivate_items(list(item_keys))
+
+
+def expired_item_ids(cell_name, now):
+	"""
+	Returns the ids of the items in a cell whose ttl or ttd lets them be
+	removed at `now`, according to the cell's expiry index.
+	"""
+	return storage.expired_item_ids(cell_name, now)
+
+
+def deletion_candidates(source_name, item_ids, now):
+	"""
+	Returns the items among the given ids in a cell that are due to be
+	removed: inactive items whose ttl has expired and items whose ttd has
+	expired.
+	"""
+	return storage.deletion_candidates(source_name, item_ids, now)
@@ -0,0 +1,56 @@
+"""
+The order of the feed and the cursors used to page through it.
+"""
+# Standard library imports
+import base64
+import heapq
+import json
+
+
+def sort_key(entry):
+	"""The key the feed is sorted by."""
+	return entry['time'] if 'time' in entry and entry['time'] else entry['created'] if 'created' in entry and entry['created'] else 0
+
+
+def position(entry):
+	"""
+	The position of an item in the feed. Ties in the sort key are broken by
+	source and id, so every item has a distinct position.
+	"""
+	return (sort_key(entry), entry['source'], entry['id'])
+
+
+def encode_cursor(entry):
+	"""Returns a cursor for the page that follows an item."""
+	data = json.dumps(position(entry), separators=(',', ':')).encode('utf8')
+	return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+	"""
+	Returns the position a cursor follows. Raises ValueError if the cursor
+	is malformed.
+	"""
+	try:
+		data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+		key, source, item_id = json.loads(data)
+	except (TypeError, ValueError) as e:
+		raise ValueError(f'Invalid cursor: {cursor}') from e
+	if (type(key) not in (int, float)
+		or type(source) is not str
+		or type(item_id) is not str):
+		raise ValueError(f'Invalid cursor: {cursor}')
+	return (key, source, item_id)
+
+
+def top_k(entries, after, limit):
+	"""
+	Returns the first `limit` entries in feed order that come after the
+	position `after`, or from the start if `after` is None, without sorting
+	all of the entries. If `limit` is None, all of them are returned.
+	"""
+	if after is not None:
+		entries = (entry for entry in entries if position(entry) > after)
+	if limit is None:
+		return sorted(entries, key=position)
+	return heapq.nsmallest(limit, entries, key=position)
@@ -0,0 +1,98 @@
+"""
+A shared HTTP session for sources, so that fetches from the same process
+reuse connections and are throttled per host.
+"""
+# Standard library imports
+from contextlib import contextmanager
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Third-party library imports
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Application imports
+from inquisitor.configs import (
+	HTTP_TIMEOUT,
+	HTTP_RETRIES,
+	HTTP_HOST_CONNECTIONS,
+	HTTP_HOST_INTERVAL)
+
+
+# Connections kept open per host, and hosts kept in the pool
+POOL_CONNECTIONS = 32
+
+# Responses that are retried, for idempotent requests only
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HostLimiter():
+	"""
+	Limits the requests in flight to each host, and spaces out the start of
+	requests to the same host by a minimum interval.
+	"""
+
+	def __init__(self, concurrency, interval):
+		self.concurrency = concurrency
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.hosts = {}
+
+	@contextmanager
+	def limit(self, host):
+		with self.lock:
+			if host not in self.hosts:
+				self.hosts[host] = (threading.BoundedSemaphore(self.concurrency), [0.0])
+			semaphore, next_start = self.hosts[host]
+		with semaphore:
+			if self.interval:
+				with self.lock:
+					start = max(time.monotonic(), next_start[0])
+					next_start[0] = start + self.interval
+				delay = start - time.monotonic()
+				if delay > 0:
+					time.sleep(delay)
+			yield
+
+
+class PooledSession(requests.Session):
+	"""
+	A requests session with a default timeout, retries with exponential
+	backoff for failed and rate-limited GET and HEAD requests, and per-host
+	limits on concurrency and request rate. Connections are kept alive and
+	responses may be gzip or deflate compressed.
+	"""
+
+	def __init__(self, timeout, retries, host_connections, host_interval):
+		super().__init__()
+		self.timeout = timeout
+		self.limiter = HostLimiter(host_connections, host_interval)
+		retry = Retry(
+			total=retries,
+			backoff_factor=0.5,
+			status_forcelist=RETRY_STATUSES,
+			allowed_methods=frozenset(('GET', 'HEAD')),
+			respect_retry_after_header=True,
+			raise_on_status=False)
+		adapter = HTTPAdapter(
+			pool_connections=POOL_CONNECTIONS,
+			pool_maxsize=max(POOL_CONNECTIONS, host_connections),
+			max_retries=retry)
+		self.mount('http://', adapter)
+		self.mount('https://', adapter)
+		self.headers['Accept-Encoding'] = 'gzip, deflate'
+
+	def request(self, method, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		with self.limiter.limit(urlsplit(url).netloc):
+			return super().request(method, url, **kwargs)
+
+
+# The session shared by everything in this process
+session = PooledSession(
+	HTTP_TIMEOUT,
+	HTTP_RETRIES,
+	HTTP_HOST_CONNECTIONS,
+	HTTP_HOST_INTERVAL)
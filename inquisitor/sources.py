@@ -1,25 +1,26 @@
 import os
 import traceback
+import hashlib
 import importlib.util
 import json
+import multiprocessing
+import multiprocessing.connection
 import sys
+import threading
+import time
 
 
 from inquisitor import loader, timestamp, error
+from inquisitor.storage import Batch, USE_NEWEST, item_digest
 from inquisitor.configs import SOURCES_PATH, DUNGEON_PATH, logger
 
 
-USE_NEWEST = (
-	'title',
-	'tags',
-	'link',
-	'time'
-	'author',
-	'body',
-	'ttl',
-	'ttd',
-	'tts',
-)
+# Updates are run in forked processes, which share the modules loaded by
+# the parent.
+fork = multiprocessing.get_context('fork')
+
+# Exit status of an update process that reported its own error
+UPDATE_FAILED = 2
 
 
 class InquisitorStubSource:
@@ -32,116 +33,320 @@ def ensure_cell(name):
 	"""
 	Creates a cell in the dungeon. Idempotent.
 	"""
-	cell_path = os.path.join(DUNGEON_PATH, name)
-	if not os.path.isdir(cell_path):
-		logger.info(f'Creating cell for source "{name}"')
-		os.mkdir(cell_path)
-	state_path = os.path.join(cell_path, 'state')
-	if not os.path.isfile(state_path):
-		with open(state_path, 'w', encoding='utf8') as state:
-			json.dump({}, state)
+	loader.ensure_cell(name)
 
 
-def update_sources(*source_names):
+def update_sources(*source_names, jobs=1, timeout=None):
 	"""
-	Attempts to update each given source.
+	Attempts to update each given source. With more than one job, or with a
+	timeout, each source is updated in its own process, up to `jobs` at a
+	time, and a source that runs longer than `timeout` seconds is killed.
 	"""
+	source_names = list(dict.fromkeys(source_names))
+	if jobs <= 1 and timeout is None:
+		for source_name in source_names:
+			update_one(source_name)
+		return
+
+	pool = UpdatePool(jobs, timeout)
 	for source_name in source_names:
-		# Import the source
+		while pool.full():
+			pool.wait()
+		pool.start(source_name)
+	while pool.running:
+		pool.wait()
+
+
+def update_one(source_name, source_module=None):
+	"""
+	Attempts to update a source, reporting any errors as items. The source
+	is loaded unless its module is given. Returns whether the update
+	succeeded.
+	"""
+	# Import the source
+	if source_module is None:
 		try:
 			source_module = load_source(source_name)
 		except Exception:
 			error.as_item(
 				f'Error importing source "{source_name}"',
 				traceback.format_exc())
-			continue
+			return False
 
-		# If it doesn't have a cell yet, create one
-		try:
-			ensure_cell(source_name)
-		except Exception:
-			error.as_item(
-				f'Error initializing source "{source_name}"',
-				traceback.format_exc())
-			continue
+	# If it doesn't have a cell yet, create one
+	try:
+		ensure_cell(source_name)
+	except Exception:
+		error.as_item(
+			f'Error initializing source "{source_name}"',
+			traceback.format_exc())
+		return False
 
-		# Update the source
-		try:
-			logger.info(f'Updating source "{source_name}"')
-			update_source(source_name, source_module)
-		except Exception:
-			error.as_item(
-				f'Error updating source "{source_name}"',
-				traceback.format_exc())
+	# Update the source
+	try:
+		logger.info(f'Updating source "{source_name}"')
+		update_source(source_name, source_module)
+	except Exception:
+		error.as_item(
+			f'Error updating source "{source_name}"',
+			traceback.format_exc())
+		return False
+	return True
 
 
-def load_source(source_name):
+def update_in_child(source_name, source_module):
 	"""
-	Attempts to load the source module with the given name.
-	Raises an exception on failure.
+	Updates a source in a child process, exiting with a status that tells
+	the parent whether it succeeded.
 	"""
-	if source_name == 'inquisitor':
-		return InquisitorStubSource()
+	success = update_one(source_name, source_module)
+	sys.exit(0 if success else UPDATE_FAILED)
 
-	cwd = os.getcwd()
-	try:
-		# Push the sources directory.
-		os.chdir(SOURCES_PATH)
-		# Make the sources directory importable while working with sources.
-		if SOURCES_PATH not in sys.path:
-			sys.path.insert(0, SOURCES_PATH)
+
+class UpdatePool():
+	"""
+	Runs source updates in child processes, a limited number at a time,
+	and kills those that run past a timeout. The children are forked, so
+	a source module loaded before an update is started is not imported
+	again by the child.
+	"""
+
+	def __init__(self, jobs, timeout=None):
+		self.jobs = jobs
+		self.timeout = timeout
+		# source name -> (process, deadline)
+		self.running = {}
+
+	def full(self):
+		return len(self.running) >= self.jobs
+
+	def start(self, source_name, source_module=None):
+		"""Starts updating a source."""
+		process = fork.Process(
+			target=update_in_child,
+			args=(source_name, source_module),
+			name=f'update-{source_name}')
+		process.start()
+		deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+		self.running[source_name] = (process, deadline)
+
+	def wait(self, until=None):
+		"""
+		Waits for an update to finish or be killed, or until the monotonic
+		time `until`. Returns a list of (source name, success) pairs for the
+		updates that ended.
+		"""
+		deadlines = [deadline for _, deadline in self.running.values() if deadline is not None]
+		if until is not None:
+			deadlines.append(until)
+		wait_for = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+		if self.running:
+			multiprocessing.connection.wait(
+				[process.sentinel for process, _ in self.running.values()],
+				wait_for)
+		elif wait_for:
+			time.sleep(wait_for)
+
+		ended = []
+		now = time.monotonic()
+		for source_name, (process, deadline) in list(self.running.items()):
+			if not process.is_alive():
+				process.join()
+				del self.running[source_name]
+				# Errors in the update itself were reported by the child
+				if process.exitcode not in (0, UPDATE_FAILED):
+					error.as_item(
+						f'Error updating source "{source_name}"',
+						f'The update process exited with code {process.exitcode}')
+				ended.append((source_name, process.exitcode == 0))
+			elif deadline is not None and now >= deadline:
+				process.kill()
+				process.join()
+				del self.running[source_name]
+				error.as_item(
+					f'Timed out updating source "{source_name}"',
+					f'The update was killed after {self.timeout:g} seconds')
+				ended.append((source_name, False))
+		return ended
+
+	def stop(self):
+		"""Kills any updates that are still running."""
+		for process, _ in self.running.values():
+			process.kill()
+			process.join()
+		self.running.clear()
+
+
+class SourceRegistry():
+	"""
+	Loads source modules from the sources directory and keeps them, so that
+	a source is only executed again when its file changes. A file whose
+	modification time changed but whose contents did not is not executed
+	again. Modules that a source imports from the sources directory are
+	imported once, like any other module.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		# source name -> (mtime and size, content hash, module)
+		self.modules = {}
+
+	def load(self, source_name):
+		"""
+		Returns the module of the named source, executing the source file if
+		it is new or has changed. Raises an exception on failure.
+		"""
+		if source_name == 'inquisitor':
+			return InquisitorStubSource()
 
 		# Check if the named source is present.
 		source_file_name = source_name + '.py'
-		if not os.path.isfile(source_file_name):
-			raise FileNotFoundError(f'Missing "{source_name}" in "{SOURCES_PATH}"')
+		source_path = os.path.join(self.path, source_file_name)
+		try:
+			stat = os.stat(source_path)
+		except FileNotFoundError:
+			raise FileNotFoundError(f'Missing "{source_name}" in "{self.path}"')
+		stamp = (stat.st_mtime_ns, stat.st_size)
 
-		# Import the source module by file path.
-		logger.debug(f'Loading module "{source_file_name}"')
-		spec = importlib.util.spec_from_file_location(source_name, source_file_name)
-		itemsource = importlib.util.module_from_spec(spec)
-		spec.loader.exec_module(itemsource)
-		itemsource = importlib.import_module(source_name)
+		with self.lock:
+			cached = self.modules.get(source_name)
+			if cached and cached[0] == stamp:
+				return cached[2]
+			with open(source_path, 'rb') as f:
+				digest = hashlib.sha256(f.read()).hexdigest()
+			if cached and cached[1] == digest:
+				self.modules[source_name] = (stamp, digest, cached[2])
+				return cached[2]
 
-		# Require fetch_new().
-		if not hasattr(itemsource, 'fetch_new'):
-			raise ImportError(f'Missing fetch_new in "{source_file_name}"')
+			if cached:
+				logger.info(f'Reloading changed source "{source_name}"')
+			itemsource = self.execute(source_name, source_path)
+			self.modules[source_name] = (stamp, digest, itemsource)
+			return itemsource
 
+	def execute(self, source_name, source_path):
+		"""
+		Imports a source module by file path. The sources directory is only
+		importable while the module executes.
+		"""
+		logger.debug(f'Loading module "{os.path.basename(source_path)}"')
+		spec = importlib.util.spec_from_file_location(source_name, source_path)
+		itemsource = importlib.util.module_from_spec(spec)
+		previous = sys.modules.get(source_name)
+		sys.modules[source_name] = itemsource
+		added_path = self.path not in sys.path
+		if added_path:
+			sys.path.insert(0, self.path)
+		try:
+			spec.loader.exec_module(itemsource)
+			# Require fetch_new().
+			if not hasattr(itemsource, 'fetch_new'):
+				raise ImportError(f'Missing fetch_new in "{os.path.basename(source_path)}"')
+		except BaseException:
+			# Keep the last working version of the module importable
+			if previous is not None:
+				sys.modules[source_name] = previous
+			else:
+				del sys.modules[source_name]
+			raise
+		finally:
+			if added_path:
+				sys.path.remove(self.path)
 		return itemsource
 
-	finally:
-		os.chdir(cwd)
-		if SOURCES_PATH in sys.path:
-			sys.path.remove(SOURCES_PATH)
+
+# The sources in the sources directory in the config file
+registry = SourceRegistry(SOURCES_PATH)
+
+
+def load_source(source_name):
+	"""
+	Attempts to load the source module with the given name, reusing the
+	loaded module if its file has not changed.
+	Raises an exception on failure.
+	"""
+	return registry.load(source_name)
 
 
 def update_source(source_name, source):
 	"""
 	Attempts to update the given source. Raises an exception if the source does.
+	Returns the number of new, updated, unchanged and deleted items.
 	"""
-	# Get a list of item ids that already existed in this source's cell.
-	prior_ids = loader.get_item_ids(source_name)
-	logger.debug(f'Found {len(prior_ids)} prior items')
-
-	# Get the feed items from the source's fetch method.
-	state = loader.load_state(source_name)
-	fetched = source.fetch_new(state)
-	state.flush()
-	logger.debug(f'Fetched {len(fetched)} items')
-	fetched_items = {item['id']: item for item in fetched}
-
-	# Determine which items are new and which are updates.
-	# We query the file system here instead of checking against this source's
-	# item ids from above because sources are allowed to generate in other
-	# sources' cells.
+	# Writes to items and the state are batched so that each is written once.
+	with loader.batch() as batch:
+		# Get the feed items from the source's fetch method.
+		state = loader.load_state(source_name)
+		fetched = source.fetch_new(state)
+		batch.add(state)
+		logger.debug(f'Fetched {len(fetched)} items')
+
+		# Sources are allowed to generate in other sources' cells, so every
+		# cell written to is locked until the writes are committed, in case
+		# another update is running in parallel.
+		cell_names = {source_name}
+		cell_names.update(item.get('source', source_name) for item in fetched)
+		with loader.lock_cells(cell_names):
+			try:
+				return write_fetched(source_name, source, state, fetched)
+			finally:
+				batch.commit()
+
+
+def write_fetched(source_name, source, state, fetched):
+	"""
+	Creates, updates and deletes a source's items to match what it fetched.
+	Returns the number of new, updated, unchanged and deleted items.
+	"""
+	# Each cell the fetched items belong to is listed once. Sources are
+	# allowed to generate in other sources' cells, so this is not only the
+	# source's own cell.
+	listings = {}
+	def listing(cell_name):
+		if cell_name not in listings:
+			listings[cell_name] = loader.load_manifest(cell_name)
+		return listings[cell_name]
+	# An item can be written without its listing entry, such as by an
+	# update killed in between or after the manifest was lost. The cell is
+	# then listed again from its item files, once per update.
+	relisted = set()
+	def find_entry(cell_name, item_id):
+		entry = listing(cell_name).get(item_id)
+		if entry is None and cell_name not in relisted and loader.item_exists(cell_name, item_id):
+			logger.warning(f'Relisting "{cell_name}", which is missing {item_id}')
+			relisted.add(cell_name)
+			loader.reindex(cell_name)
+			listings[cell_name] = loader.load_manifest(cell_name)
+			entry = listing(cell_name).get(item_id)
+		return entry
+	prior_entries = listing(source_name)
+	logger.debug(f'Found {len(prior_entries)} prior items')
+
+	# Determine which items are new, which may be updates, and which are
+	# unchanged. An item is unchanged if the digest of its updatable fields
+	# matches the stored item's, with the defaults new items are given.
 	new_items = []
 	updated_items = []
+	unchanged_count = 0
+	fetched_ids = set()
 	for item in fetched:
 		item_source = item.get('source', source_name)
-		if loader.item_exists(item_source, item['id']):
-			updated_items.append(item)
+		if item_source == source_name:
+			fetched_ids.add(item['id'])
+		entry = find_entry(item_source, item['id'])
+		if entry is None:
+			# An unreadable item file is left to the update to report
+			if loader.item_exists(item_source, item['id']):
+				updated_items.append(item)
+			else:
+				new_items.append(item)
+			continue
+		digest = item_digest({'title': item['id'], 'tags': [item_source], **item})
+		if entry.get('digest') == digest:
+			unchanged_count += 1
 		else:
-			new_items.append(item)
+			updated_items.append(item)
 
 	# Write all the new items to the source's cell.
 	has_create_handler = hasattr(source, 'on_create')
@@ -159,80 +364,144 @@ def update_source(source_name, source):
 					traceback.format_exc())
 
 	# Update the other items using the fetched items' values.
+	updated_count = 0
 	for new_item in updated_items:
-		old_item = loader.load_item(new_item['source'], new_item['id'])
+		old_item = loader.load_item(new_item.get('source', source_name), new_item['id'])
+		changed = False
 		for field in USE_NEWEST:
-			if field in new_item and old_item[field] != new_item[field]:
+			if field in new_item and (field not in old_item or old_item[field] != new_item[field]):
 				old_item[field] = new_item[field]
+				changed = True
 		if 'callback' in new_item:
 			old_callback = old_item.get('callback', {})
 			# Because of the way this update happens, any fields that are set
 			# in the callback when the item is new will keep their original
 			# values, as those values reappear in new_item on subsequent
 			# updates.
-			old_item['callback'] = {**old_item['callback'], **new_item['callback']}
+			callback = {**old_callback, **new_item['callback']}
+			if callback != old_callback:
+				old_item['callback'] = callback
+				changed = True
+		if changed:
+			updated_count += 1
+		else:
+			unchanged_count += 1
 
 	# In general, items are removed when they are old (not found in the last
 	# fetch) and inactive. Some item fields can change this basic behavior.
-	del_count = 0
+	# Only the items the expiry index says are due are considered.
 	now = timestamp.now()
-	has_delete_handler = hasattr(source, 'on_delete')
-	fetched_ids = [item['id'] for item in updated_items]
 	old_item_ids = [
-		item_id for item_id in prior_ids
+		item_id for item_id in loader.expired_item_ids(source_name, now)
 		if item_id not in fetched_ids]
-	for item_id in old_item_ids:
-		item = loader.load_item(source_name, item_id)
-		remove = not item['active']
-		# The time-to-live field protects an item from removal until expiry.
-		# This is mainly used to avoid old items resurfacing when their source
-		# cannot guarantee monotonicity.
-		if 'ttl' in item:
-			ttl_date = item['created'] + item['ttl']
-			if ttl_date > now:
-				continue
-		# The time-to-die field can force an active item to be removed.
-		if 'ttd' in item:
-			ttd_date = item['created'] + item['ttd']
-			if ttd_date < now:
-				remove = True
-		# Items to be removed are deleted
-		if remove:
-			try:
-				if has_delete_handler:
-					# Run the delete handler so exceptions prevent deletions
-					source.on_delete(state, item)
-				loader.delete_item(source_name, item['id'])
-				del_count += 1
-			except:
-				error.as_item(
-					f'Failed to delete {source_name}/{item["id"]}',
-					traceback.format_exc())
+	candidates = loader.deletion_candidates(source_name, old_item_ids, now)
+	del_count = delete_items(source_name, source, state, candidates)
 
-	# Note update timestamp in state
+	# Note update timestamp in state, and the items fetched so that they are
+	# not collected before the next update
 	state['last_updated'] = timestamp.now()
+	state['last_fetched'] = sorted(fetched_ids)
 
 	# Log counts
-	logger.info("{} new item{}, {} deleted item{}".format(
+	counts = {
+		'new': len(new_items),
+		'updated': updated_count,
+		'unchanged': unchanged_count,
+		'deleted': del_count,
+	}
+	logger.info("{} new item{}, {} updated, {} unchanged, {} deleted".format(
 		len(new_items), "s" if len(new_items) != 1 else "",
-		del_count, "s" if del_count != 1 else ""))
+		updated_count, unchanged_count, del_count))
+	return counts
+
+
+def delete_items(source_name, source, state, items):
+	"""
+	Deletes items from a source's cell, running the source's on-delete
+	handler first. Returns the number of items deleted.
+	"""
+	del_count = 0
+	has_delete_handler = hasattr(source, 'on_delete')
+	for item in items:
+		try:
+			if has_delete_handler:
+				# Run the delete handler so exceptions prevent deletions
+				source.on_delete(state, item)
+			loader.delete_item(source_name, item['id'])
+			# Changes the handler made to the item are not written back
+			# over its deletion when the batch commits.
+			batch = Batch.active()
+			if batch:
+				batch.discard(item)
+			del_count += 1
+		except:
+			error.as_item(
+				f'Failed to delete {source_name}/{item["id"]}',
+				traceback.format_exc())
+	return del_count
+
+
+def collect_cell(cell_name):
+	"""
+	Deletes the expired items in a cell without updating its source. Items
+	the source returned in its last update are kept, as an update would
+	keep them. Returns the number of items deleted.
+	"""
+	with loader.lock_cells([cell_name]), loader.batch() as batch:
+		now = timestamp.now()
+		expired_ids = loader.expired_item_ids(cell_name, now)
+		if not expired_ids:
+			return 0
+		# Cells made by hand may not have a state yet
+		ensure_cell(cell_name)
+		state = loader.load_state(cell_name)
+		last_fetched = set(state.get('last_fetched', []))
+		old_item_ids = [
+			item_id for item_id in expired_ids
+			if item_id not in last_fetched]
+		candidates = loader.deletion_candidates(cell_name, old_item_ids, now)
+		if not candidates:
+			return 0
+		# The source is only loaded for its on-delete handler. Cells without
+		# a source module, such as the error cell, have no handler. A source
+		# that fails to import keeps its items, as a failing handler would.
+		try:
+			source = load_source(cell_name)
+		except FileNotFoundError:
+			source = None
+		except Exception:
+			error.as_item(
+				f'Error importing source "{cell_name}"',
+				traceback.format_exc())
+			return 0
+		count = delete_items(cell_name, source, state, candidates)
+		batch.add(state)
+		return count
 
 
 def item_callback(source_name, itemid):
+	"""
+	Runs a source's callback on one of its items, reporting any errors as
+	items. Returns whether the callback succeeded.
+	"""
 	try:
 		# Load the module with the callback function
 		source_module = load_source(source_name)
 		if not hasattr(source_module, 'callback'):
 			raise ImportError(f"Missing callback in '{source_name}'")
-		# Load the source state and the origin item
-		state = loader.load_state(source_name)
-		item = loader.load_item(source_name, itemid)
-		# Execute callback
-		source_module.callback(state, item)
-		# Save any changes
-		item.flush()
-		state.flush()
+		# Execute callback and save any changes, including those made to
+		# nested values. The cell is locked so that an update running at the
+		# same time does not write over them.
+		with loader.lock_cells([source_name]), loader.batch() as batch:
+			# Load the source state and the origin item
+			state = loader.load_state(source_name)
+			item = loader.load_item(source_name, itemid)
+			source_module.callback(state, item)
+			batch.add(item)
+			batch.add(state)
+		return True
 	except Exception:
 		error.as_item(
 			f"Error executing callback for {source_name}/{itemid}",
 			traceback.format_exc())
+		return False
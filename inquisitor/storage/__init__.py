@@ -0,0 +1,15 @@
+from .files import FileStorage, WritethroughDict, Batch, USE_NEWEST, item_digest
+from .sqlite import SqliteStorage
+
+
+def open_storage(backend):
+	"""
+	Returns the configured storage for the named backend.
+	"""
+	from inquisitor.configs import (
+		DUNGEON_PATH, DATABASE_PATH, ITEM_ENCODING, SCAN_THREADS)
+	if backend == 'files':
+		return FileStorage(DUNGEON_PATH, ITEM_ENCODING, SCAN_THREADS)
+	if backend == 'sqlite':
+		return SqliteStorage(DATABASE_PATH)
+	raise ValueError(f'Unknown storage backend: {backend}')
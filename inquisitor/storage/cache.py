@@ -0,0 +1,75 @@
+import copy
+import os
+import threading
+from collections import OrderedDict
+
+from inquisitor.storage.encoding import decode
+
+
+class ItemCache():
+	"""
+	A least-recently-used cache of parsed item files, bounded by the total
+	size of the cached files. Entries are validated against the file's
+	modification time and size, so only items changed since they were
+	cached are parsed again.
+	"""
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.size = 0
+		# path -> ((mtime_ns, size), item, data)
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def load(self, path):
+		"""
+		Returns a copy of the parsed item at a path and the data it was
+		parsed from. The copy is deep, so that changes to nested values such
+		as tags and callbacks do not reach the cached item.
+		"""
+		stat = os.stat(path)
+		key = (stat.st_mtime_ns, stat.st_size)
+		with self.lock:
+			cached = self.entries.get(path)
+			if cached and cached[0] == key:
+				self.hits += 1
+				self.entries.move_to_end(path)
+				_, item, data = cached
+				return copy.deepcopy(item), data
+			self.misses += 1
+		with open(path, 'rb') as f:
+			data = f.read()
+		item = decode(data)
+		self.store(path, key, item, data)
+		return copy.deepcopy(item), data
+
+	def store(self, path, key, item, data):
+		with self.lock:
+			self.discard(path)
+			self.entries[path] = (key, item, data)
+			self.size += key[1]
+			while self.size > self.max_bytes and self.entries:
+				_, ((_, size), _, _) = self.entries.popitem(last=False)
+				self.size -= size
+
+	def forget(self, path):
+		"""Drops a path from the cache, such as after it is written."""
+		with self.lock:
+			self.discard(path)
+
+	def discard(self, path):
+		cached = self.entries.pop(path, None)
+		if cached:
+			self.size -= cached[0][1]
+
+	def stats(self):
+		with self.lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'items': len(self.entries),
+				'bytes': self.size,
+				'max_bytes': self.max_bytes,
+			}
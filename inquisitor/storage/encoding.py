@@ -0,0 +1,129 @@
+"""
+Encodings for item files. Items are written as pretty-printed JSON or as a
+compact protobuf message, and either can be read back regardless of the
+encoding currently configured.
+"""
+import json
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+
+# Protobuf item files begin with this header, which JSON text cannot.
+PROTOBUF_MAGIC = b'\x00inq\x01'
+
+FieldProto = descriptor_pb2.FieldDescriptorProto
+
+# The item fields with dedicated protobuf fields. Field numbers must never
+# change. Numeric fields are stored as an integer field, or as a double in
+# the field named with a _real suffix, so that both types round-trip. Any
+# field whose value does not fit its dedicated field is kept in `extra` as
+# a JSON object.
+ITEM_FIELDS = (
+	('id', 1, FieldProto.TYPE_STRING),
+	('source', 2, FieldProto.TYPE_STRING),
+	('title', 3, FieldProto.TYPE_STRING),
+	('link', 4, FieldProto.TYPE_STRING),
+	('author', 5, FieldProto.TYPE_STRING),
+	('body', 6, FieldProto.TYPE_STRING),
+	('active', 7, FieldProto.TYPE_BOOL),
+	('created', 8, FieldProto.TYPE_SINT64),
+	('created_real', 9, FieldProto.TYPE_DOUBLE),
+	('time', 10, FieldProto.TYPE_SINT64),
+	('time_real', 11, FieldProto.TYPE_DOUBLE),
+	('ttl', 12, FieldProto.TYPE_SINT64),
+	('ttl_real', 13, FieldProto.TYPE_DOUBLE),
+	('ttd', 14, FieldProto.TYPE_SINT64),
+	('ttd_real', 15, FieldProto.TYPE_DOUBLE),
+	('tts', 16, FieldProto.TYPE_SINT64),
+	('tts_real', 17, FieldProto.TYPE_DOUBLE),
+	('tags', 18, FieldProto.TYPE_STRING),
+	('extra', 19, FieldProto.TYPE_STRING),
+)
+STRING_FIELDS = {'id', 'source', 'title', 'link', 'author', 'body'}
+NUMBER_FIELDS = {'created', 'time', 'ttl', 'ttd', 'tts'}
+INT64_RANGE = range(-2**63, 2**63)
+
+
+def build_item_message():
+	"""
+	Builds the protobuf message class for items from ITEM_FIELDS, so that
+	no generated code is needed.
+	"""
+	file_proto = descriptor_pb2.FileDescriptorProto(
+		name='inquisitor/item.proto',
+		package='inquisitor',
+		syntax='proto2')
+	message_proto = file_proto.message_type.add(name='Item')
+	for name, number, field_type in ITEM_FIELDS:
+		message_proto.field.add(
+			name=name,
+			number=number,
+			type=field_type,
+			label=(
+				FieldProto.LABEL_REPEATED
+				if name == 'tags' else
+				FieldProto.LABEL_OPTIONAL))
+	pool = descriptor_pool.DescriptorPool()
+	pool.Add(file_proto)
+	descriptor = pool.FindMessageTypeByName('inquisitor.Item')
+	if hasattr(message_factory, 'GetMessageClass'):
+		return message_factory.GetMessageClass(descriptor)
+	return message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+
+Item = build_item_message()
+
+
+def encode_protobuf(item):
+	message = Item()
+	extra = {}
+	for key, value in item.items():
+		if key in STRING_FIELDS and type(value) is str:
+			setattr(message, key, value)
+		elif key == 'active' and type(value) is bool:
+			message.active = value
+		elif key in NUMBER_FIELDS and type(value) is int and value in INT64_RANGE:
+			setattr(message, key, value)
+		elif key in NUMBER_FIELDS and type(value) is float:
+			setattr(message, key + '_real', value)
+		elif key == 'tags' and value and all(type(tag) is str for tag in value):
+			message.tags.extend(value)
+		else:
+			extra[key] = value
+	if extra:
+		message.extra = json.dumps(extra)
+	return PROTOBUF_MAGIC + message.SerializeToString()
+
+
+def decode_protobuf(data):
+	message = Item.FromString(data[len(PROTOBUF_MAGIC):])
+	item = {}
+	for field, value in message.ListFields():
+		name = field.name
+		if name == 'extra':
+			item.update(json.loads(value))
+		elif name == 'tags':
+			item['tags'] = list(value)
+		elif name.endswith('_real'):
+			item[name[:-5]] = value
+		else:
+			item[name] = value
+	return item
+
+
+def encode(item, encoding):
+	"""
+	Serializes an item to bytes in the given encoding.
+	"""
+	if encoding == 'protobuf':
+		return encode_protobuf(item)
+	return json.dumps(item, indent=2).encode('utf8')
+
+
+def decode(data):
+	"""
+	Deserializes an item from bytes in any encoding.
+	"""
+	if data.startswith(PROTOBUF_MAGIC):
+		return decode_protobuf(data)
+	return json.loads(data)
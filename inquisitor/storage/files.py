@@ -0,0 +1,789 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+
+from inquisitor.configs import logger
+from inquisitor.storage.cache import ItemCache
+from inquisitor.storage.encoding import encode, decode
+from inquisitor.storage.index import CellIndex
+
+
+# Each cell keeps a manifest of the item fields needed to select and sort
+# the feed, so the feed can be built without opening every item file.
+MANIFEST_FILE = 'manifest'
+MANIFEST_FIELDS = ('id', 'active', 'created', 'time', 'ttl', 'ttd', 'tts', 'tags')
+# The manifest is an append-only log, compacted once it has grown this many
+# lines beyond twice the number of items it describes.
+MANIFEST_SLACK = 1000
+
+# The item fields that an update copies from a fetched item to the stored
+# item. Manifest entries include a digest of these fields and the callback,
+# so an update can skip the fetched items that would not change anything
+# without reading the stored items.
+USE_NEWEST = (
+	'title',
+	'tags',
+	'link',
+	'time',
+	'author',
+	'body',
+	'ttl',
+	'ttd',
+	'tts',
+)
+DIGEST_FIELDS = USE_NEWEST + ('callback',)
+
+# A cell may override the configured item encoding with this file, which
+# contains the name of the encoding for new writes to that cell.
+CELL_ENCODING_FILE = 'encoding'
+
+# The dungeon's generation counter, which is incremented whenever an item
+# is created, changed or deleted.
+GENERATION_FILE = 'generation'
+
+# Held by an update while it writes to a cell, so that updates running in
+# parallel do not interleave their writes to the same items.
+UPDATE_LOCK_FILE = 'lock'
+
+
+class Batch():
+	"""
+	Collects writes to writethrough dictionaries so that each dictionary
+	changed within the batch is written once when the batch ends. Batches
+	opened within a batch join the outer batch.
+	"""
+	current = threading.local()
+
+	@staticmethod
+	def active():
+		"""Returns the batch open in this thread, if any."""
+		return getattr(Batch.current, 'batch', None)
+
+	def __init__(self, transaction=nullcontext):
+		self.transaction = transaction
+		self.dirty = {}
+		self.outer = None
+
+	def __enter__(self):
+		self.outer = Batch.active()
+		if self.outer is None:
+			Batch.current.batch = self
+		return self.outer or self
+
+	def __exit__(self, *exc_info):
+		if self.outer is not None:
+			return
+		Batch.current.batch = None
+		# Changes made before an exception are still written, as they would
+		# have been without the batch.
+		self.commit()
+
+	def add(self, wd):
+		"""Marks a dictionary to be written when the batch ends."""
+		self.dirty[id(wd)] = wd
+
+	def discard(self, wd):
+		"""Unmarks a dictionary, such as one that has been deleted."""
+		self.dirty.pop(id(wd), None)
+
+	def commit(self):
+		with self.transaction():
+			for wd in self.dirty.values():
+				wd.flush()
+		self.dirty.clear()
+
+
+class WritethroughDict():
+	"""A wrapper for a dictionary saved to the file system."""
+
+	@staticmethod
+	def create(path, item, encoding='json'):
+		"""
+		Creates a writethrough dictionary from a dictionary in memory and
+		initializes a file to save it.
+		"""
+		if os.path.isfile(path):
+			raise FileExistsError(path)
+		wd = WritethroughDict(path, item)
+		wd.encoding = encoding
+		wd.indexed = None
+		wd.flush()
+		return wd
+
+	@staticmethod
+	def load(path):
+		"""
+		Creates a writethrough dictionary from an existing file in the
+		file system.
+		"""
+		if not os.path.isfile(path):
+			raise FileNotFoundError(path)
+		with open(path, 'rb') as f:
+			data = f.read()
+		wd = WritethroughDict(path, decode(data))
+		wd.written = data
+		return wd
+
+	def __init__(self, path, item):
+		self.path = path
+		self.fields = item
+		# The serialized dictionary as last read or written
+		self.written = None
+		# The encoding used when the dictionary is written
+		self.encoding = 'json'
+		# The item cache this dictionary was loaded through, if any
+		self.cache = None
+		# The manifest entry last written for this item, if it is known
+		self.indexed = None
+		# A function that looks up the item's manifest entry, whose body
+		# digest is used instead of reading an unchanged body
+		self.lookup_entry = None
+		# Item bodies are kept in a separate file and only read when needed.
+		# Items written before this may still have their body inline.
+		self.body_path = path[:-5] + '.body' if path.endswith('.item') else None
+		self.body_loaded = self.body_path is None or 'body' in item
+		self.body_written = None
+
+	@property
+	def item(self):
+		"""The full dictionary, including the body."""
+		self.load_body()
+		return self.fields
+
+	def load_body(self):
+		if self.body_loaded:
+			return
+		try:
+			with open(self.body_path, encoding='utf8') as f:
+				self.fields['body'] = self.body_written = f.read()
+		except FileNotFoundError:
+			pass
+		self.body_loaded = True
+
+	def has_body(self):
+		"""Checks for a body without reading it."""
+		if self.body_loaded:
+			return 'body' in self.fields
+		return os.path.isfile(self.body_path)
+
+	def body_size(self):
+		"""
+		Returns the size of the body in bytes without reading it, or None if
+		there is no body.
+		"""
+		if self.body_loaded:
+			body = self.fields.get('body')
+			return None if body is None else len(str(body).encode('utf8'))
+		try:
+			return os.path.getsize(self.body_path)
+		except FileNotFoundError:
+			return None
+
+	def headers(self):
+		"""Returns the fields of the dictionary other than the body."""
+		return {
+			key: value
+			for key, value in self.fields.items()
+			if key != 'body'
+		}
+
+	def __getitem__(self, key):
+		if key == 'body':
+			self.load_body()
+		return self.fields[key]
+
+	def get(self, key, *args):
+		if key == 'body':
+			self.load_body()
+		return self.fields.get(key, *args)
+
+	def __setitem__(self, key, value):
+		if key == 'body':
+			self.load_body()
+		self.fields[key] = value
+		batch = Batch.active()
+		if batch:
+			batch.add(self)
+		else:
+			self.flush()
+
+	def __contains__(self, key):
+		if key == 'body':
+			self.load_body()
+		return key in self.fields
+
+	def __repr__(self):
+		return repr(self.fields)
+
+	def __str__(self):
+		return str(self.fields)
+
+	def flush(self):
+		fields = self.fields
+		body_changed = False
+		if self.body_path and self.body_loaded:
+			body = fields.get('body')
+			if isinstance(body, str):
+				fields = self.headers()
+				# The body is written first so it exists once the item does
+				if body != self.body_written:
+					with open(self.body_path, 'w', encoding='utf8') as f:
+						f.write(body)
+					self.body_written = body
+					body_changed = True
+			elif self.body_written is not None:
+				os.remove(self.body_path)
+				self.body_written = None
+				body_changed = True
+		data = encode(fields, self.encoding)
+		if data != self.written:
+			with open(self.path, 'wb') as f:
+				f.write(data)
+			self.written = data
+			if self.cache:
+				self.cache.forget(self.path)
+		elif not body_changed:
+			return
+		# Keep the cell manifest in sync when the indexed fields change
+		if self.path.endswith('.item'):
+			entry = self.index_entry()
+			if entry != self.indexed:
+				append_manifest(os.path.dirname(self.path), [entry])
+				self.indexed = entry
+			bump_generation(os.path.dirname(os.path.dirname(self.path)))
+
+
+	def index_entry(self):
+		"""
+		Returns the manifest entry for the item. A body that has not been
+		read is unchanged, so its digest is taken from the item's current
+		manifest entry instead of reading it.
+		"""
+		if not self.body_loaded:
+			entry = self.indexed or (self.lookup_entry and self.lookup_entry())
+			if entry and 'digest' in entry:
+				if 'bodydigest' in entry:
+					return index_entry(self.fields, entry['bodydigest'])
+				if not os.path.isfile(self.body_path):
+					return index_entry(self.fields)
+		return index_entry(self.item)
+
+
+def manifest_entry(item):
+	"""
+	Returns the manifest entry describing an item.
+	"""
+	return {
+		field: item[field]
+		for field in MANIFEST_FIELDS
+		if field in item
+	}
+
+
+def digest(value):
+	data = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+	return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def item_digest(item, body_digest=None):
+	"""
+	Returns a digest of the fields of an item that an update may change.
+	The body is included by its own digest, which is given as
+	`body_digest` for an item whose body was not read.
+	"""
+	if 'body' in item:
+		body_digest = digest(item['body'])
+	fields = [
+		[field, body_digest if field == 'body' else item[field]]
+		for field in DIGEST_FIELDS
+		if field in item or field == 'body' and body_digest]
+	return digest(fields)
+
+
+def index_entry(item, body_digest=None):
+	"""
+	Returns the manifest entry written for an item, which is its manifest
+	entry with the digests of its updatable fields and of its body. The
+	body digest is given as `body_digest` for an item whose body was not
+	read.
+	"""
+	if 'body' in item:
+		body_digest = digest(item['body'])
+	entry = {**manifest_entry(item), 'digest': item_digest(item, body_digest)}
+	if body_digest:
+		entry['bodydigest'] = body_digest
+	return entry
+
+
+def is_expired(item, now):
+	"""
+	Checks whether an item is due to be removed when its source no longer
+	fetches it: an inactive item whose ttl has expired, or an item whose
+	ttd has expired.
+	"""
+	remove = not item['active']
+	# The time-to-live field protects an item from removal until
+	# expiry. This is mainly used to avoid old items resurfacing
+	# when their source cannot guarantee monotonicity.
+	if 'ttl' in item:
+		ttl_date = item['created'] + item['ttl']
+		if ttl_date > now:
+			return False
+	# The time-to-die field can force an active item to be removed.
+	if 'ttd' in item:
+		ttd_date = item['created'] + item['ttd']
+		if ttd_date < now:
+			remove = True
+	return remove
+
+
+@contextmanager
+def cell_lock(cell_path):
+	"""
+	Holds an exclusive lock on a cell directory while the manifest is
+	being written.
+	"""
+	fd = os.open(cell_path, os.O_RDONLY)
+	try:
+		fcntl.flock(fd, fcntl.LOCK_EX)
+		yield
+	finally:
+		os.close(fd)
+
+
+@contextmanager
+def lock_files(paths):
+	"""
+	Holds exclusive locks on the given lock files. The locks are taken in
+	sorted order, so processes locking overlapping sets cannot deadlock.
+	"""
+	fds = []
+	try:
+		for path in sorted(set(paths)):
+			fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+			fds.append(fd)
+			fcntl.flock(fd, fcntl.LOCK_EX)
+		yield
+	finally:
+		for fd in reversed(fds):
+			os.close(fd)
+
+
+def append_manifest(cell_path, entries=(), deleted=()):
+	"""
+	Records updated manifest entries and deleted item ids in a cell's
+	manifest.
+	"""
+	lines = [json.dumps(entry, separators=(',', ':')) for entry in entries]
+	lines.extend(
+		json.dumps({'id': item_id, 'deleted': True}, separators=(',', ':'))
+		for item_id in deleted)
+	if not lines:
+		return
+	manifest_path = os.path.join(cell_path, MANIFEST_FILE)
+	with cell_lock(cell_path):
+		# A missing manifest is rebuilt from the item files on next read
+		if not os.path.isfile(manifest_path):
+			return
+		with open(manifest_path, 'a', encoding='utf8') as f:
+			f.write(''.join(line + '\n' for line in lines))
+
+
+def bump_generation(dungeon_path):
+	"""
+	Increments the dungeon's generation counter.
+	"""
+	fd = os.open(os.path.join(dungeon_path, GENERATION_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+	try:
+		fcntl.flock(fd, fcntl.LOCK_EX)
+		try:
+			generation = int(os.pread(fd, 32, 0) or 0)
+		except ValueError:
+			generation = 0
+		# The counter only grows, so it always overwrites the old value
+		os.pwrite(fd, f'{generation + 1}\n'.encode('ascii'), 0)
+	finally:
+		os.close(fd)
+
+
+def read_generation(dungeon_path):
+	"""
+	Returns the dungeon's generation counter and the time it last changed.
+	"""
+	try:
+		with open(os.path.join(dungeon_path, GENERATION_FILE), 'rb') as f:
+			modified = os.fstat(f.fileno()).st_mtime
+			return int(f.read() or 0), modified
+	except (FileNotFoundError, ValueError):
+		return 0, None
+
+
+def write_manifest(cell_path, entries):
+	"""
+	Replaces a cell's manifest with a compacted one. The caller must hold
+	the cell lock.
+	"""
+	manifest_path = os.path.join(cell_path, MANIFEST_FILE)
+	temp_path = manifest_path + '.tmp'
+	with open(temp_path, 'w', encoding='utf8') as f:
+		for entry in entries.values():
+			f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+	os.replace(temp_path, manifest_path)
+
+
+class FileStorage():
+	"""
+	Stores each cell as a directory in the dungeon, with a state file, one
+	file per item, and a manifest of the items.
+	"""
+
+	def __init__(self, path, encoding='json', scan_threads=1):
+		self.path = path
+		self.encoding = encoding
+		self.cell_encodings = {}
+		self.cache = None
+		self.scan_threads = scan_threads
+		self.pool = None
+		self.pool_lock = threading.Lock()
+		# Marks the scan threads, so that work they start is not queued
+		# behind them on their own pool
+		self.scan_local = threading.local()
+		self.indexes = {}
+		self.indexes_lock = threading.Lock()
+
+	def parallel(self, func, args):
+		"""
+		Applies a function to each argument on the scan thread pool and
+		yields the results in order. A bounded number of calls are in
+		flight at once, so results can be consumed as a stream. Calls made
+		from a scan thread, such as a manifest rebuild during a query, run
+		on that thread, since waiting on the pool from inside it can leave
+		every thread waiting.
+		"""
+		if self.scan_threads <= 1 or getattr(self.scan_local, 'worker', False):
+			yield from map(func, args)
+			return
+		with self.pool_lock:
+			if self.pool is None:
+				self.pool = ThreadPoolExecutor(
+					max_workers=self.scan_threads,
+					thread_name_prefix='scan',
+					initializer=self.mark_scan_thread)
+		window = deque()
+		for arg in args:
+			window.append(self.pool.submit(func, arg))
+			if len(window) >= 4 * self.scan_threads:
+				yield window.popleft().result()
+		while window:
+			yield window.popleft().result()
+
+	def mark_scan_thread(self):
+		self.scan_local.worker = True
+
+	def scan_cell(self, cell_name):
+		"""
+		Returns the ids of the items in a cell, using the file types from
+		the directory listing instead of a stat per file.
+		"""
+		with os.scandir(self.cell_path(cell_name)) as it:
+			return [
+				entry.name[:-5]
+				for entry in it
+				if entry.name.endswith('.item') and entry.is_file()
+			]
+
+	def try_load_item(self, key):
+		"""
+		Loads an item by (source, id), returning a pair of the item and
+		None, or None and the path of the unreadable item.
+		"""
+		source_name, item_id = key
+		try:
+			return self.load_item(source_name, item_id), None
+		except Exception:
+			return None, f'{source_name}/{item_id}.item'
+
+	def iter_items(self, cell_names):
+		"""
+		Yields (item, error) pairs for every item in the given cells, with
+		the cells listed and the items read in parallel.
+		"""
+		def keys():
+			for cell_name, item_ids in zip(cell_names, self.parallel(self.scan_cell, cell_names)):
+				for item_id in item_ids:
+					yield cell_name, item_id
+		yield from self.parallel(self.try_load_item, keys())
+
+	def iter_entries(self, entries):
+		"""
+		Yields (item, error) pairs for the items described by the given
+		manifest entries, read in parallel.
+		"""
+		yield from self.parallel(
+			self.try_load_item,
+			((entry['source'], entry['id']) for entry in entries))
+
+	def enable_cache(self, max_bytes):
+		self.cache = ItemCache(max_bytes)
+
+	def cache_stats(self):
+		return self.cache.stats() if self.cache else None
+
+	def transaction(self):
+		return nullcontext()
+
+	def cell_path(self, cell_name):
+		return os.path.join(self.path, cell_name)
+
+	def lock_cells(self, cell_names):
+		return lock_files(
+			os.path.join(self.cell_path(cell_name), UPDATE_LOCK_FILE)
+			for cell_name in cell_names)
+
+	def item_path(self, source_name, item_id):
+		return os.path.join(self.path, source_name, f'{item_id}.item')
+
+	def cell_encoding(self, cell_name):
+		"""
+		Returns the encoding for items written to a cell.
+		"""
+		if cell_name not in self.cell_encodings:
+			encoding_path = os.path.join(self.cell_path(cell_name), CELL_ENCODING_FILE)
+			encoding = self.encoding
+			if os.path.isfile(encoding_path):
+				with open(encoding_path, encoding='utf8') as f:
+					encoding = f.read().strip()
+			self.cell_encodings[cell_name] = encoding
+		return self.cell_encodings[cell_name]
+
+	def set_cell_encoding(self, cell_name, encoding):
+		"""
+		Sets the encoding for items written to a cell and rewrites its items
+		in that encoding. Returns the number of items rewritten.
+		"""
+		encoding_path = os.path.join(self.cell_path(cell_name), CELL_ENCODING_FILE)
+		if encoding == self.encoding:
+			if os.path.isfile(encoding_path):
+				os.remove(encoding_path)
+		else:
+			with open(encoding_path, 'w', encoding='utf8') as f:
+				f.write(encoding + '\n')
+		self.cell_encodings[cell_name] = encoding
+		items, errors = self.load_items(cell_name)
+		for filename in errors:
+			logger.warning(f'Could not read {cell_name}/{filename}')
+		for item in items.values():
+			item.flush()
+		return len(items)
+
+	def get_cells(self):
+		with os.scandir(self.path) as it:
+			return [entry.name for entry in it if entry.is_dir()]
+
+	def cell_exists(self, cell_name):
+		return os.path.isdir(self.cell_path(cell_name))
+
+	def ensure_cell(self, cell_name):
+		cell_path = self.cell_path(cell_name)
+		if not os.path.isdir(cell_path):
+			logger.info(f'Creating cell for source "{cell_name}"')
+			os.mkdir(cell_path)
+		state_path = os.path.join(cell_path, 'state')
+		if not os.path.isfile(state_path):
+			with open(state_path, 'w', encoding='utf8') as state:
+				json.dump({}, state)
+
+	def load_state(self, cell_name):
+		state_path = os.path.join(self.path, cell_name, 'state')
+		return WritethroughDict.load(state_path)
+
+	def load_item(self, source_name, item_id):
+		path = self.item_path(source_name, item_id)
+		if not self.cache:
+			wd = WritethroughDict.load(path)
+		else:
+			item, data = self.cache.load(path)
+			wd = WritethroughDict(path, item)
+			wd.written = data
+			wd.cache = self.cache
+		wd.encoding = self.cell_encoding(source_name)
+		wd.lookup_entry = lambda: self.cell_index(source_name).entry(item_id)
+		return wd
+
+	def item_exists(self, source_name, item_id):
+		return os.path.isfile(self.item_path(source_name, item_id))
+
+	def get_item_ids(self, cell_name):
+		return self.scan_cell(cell_name)
+
+	def create_item(self, item):
+		item_path = self.item_path(item['source'], item['id'])
+		return WritethroughDict.create(item_path, item, self.cell_encoding(item['source']))
+
+	def delete_item(self, source_name, item_id):
+		path = self.item_path(source_name, item_id)
+		os.remove(path)
+		try:
+			os.remove(path[:-5] + '.body')
+		except FileNotFoundError:
+			pass
+		if self.cache:
+			self.cache.forget(path)
+		append_manifest(self.cell_path(source_name), deleted=[item_id])
+		bump_generation(self.path)
+
+	def load_items(self, source_name):
+		items = {}
+		errors = []
+		for item, error in self.iter_items([source_name]):
+			if error is None:
+				items[item['id']] = item
+			else:
+				errors.append(os.path.basename(error))
+		return items, errors
+
+	def cell_index(self, cell_name):
+		"""
+		Returns the tag index of a cell, brought up to date with its
+		manifest. The manifest is rebuilt if it does not exist and compacted
+		if it has grown too long.
+		"""
+		cell_path = self.cell_path(cell_name)
+		with self.indexes_lock:
+			if cell_name not in self.indexes:
+				self.indexes[cell_name] = CellIndex(os.path.join(cell_path, MANIFEST_FILE))
+			index = self.indexes[cell_name]
+		try:
+			index.refresh()
+		except FileNotFoundError:
+			self.rebuild_manifest(cell_name)
+			index.refresh()
+		if index.lines > 2 * len(index.entries) + MANIFEST_SLACK:
+			logger.debug(f'Compacting manifest for {cell_name}')
+			with cell_lock(cell_path):
+				index.refresh()
+				write_manifest(cell_path, index.snapshot())
+			index.refresh()
+		return index
+
+	def load_manifest(self, cell_name):
+		"""
+		Returns a map of item ids to manifest entries for a cell.
+		"""
+		return self.cell_index(cell_name).snapshot()
+
+	def rebuild_manifest(self, cell_name):
+		"""
+		Rebuilds a cell's manifest from its item files. Returns the new map
+		of item ids to manifest entries and a list of unreadable files.
+		"""
+		cell_path = self.cell_path(cell_name)
+		with cell_lock(cell_path):
+			entries = {}
+			errors = []
+			for item, error in self.iter_items([cell_name]):
+				if error is None:
+					entries[item['id']] = index_entry(item.item)
+				else:
+					errors.append(os.path.basename(error))
+			write_manifest(cell_path, entries)
+		return entries, errors
+
+	def reindex(self, cell_name):
+		entries, errors = self.rebuild_manifest(cell_name)
+		return len(entries), errors
+
+	def load_active_entries(self, source_names, now):
+		entries, _, _ = self.query_entries(source_names, (), (), now)
+		return entries
+
+	def query_entries(self, source_names, only, exclude, now):
+		entries = []
+		total = 0
+		tag_counts = {}
+		indexes = self.parallel(self.cell_index, source_names)
+		for source_name, index in zip(source_names, indexes):
+			cell_entries, cell_total, cell_tags = index.query(only, exclude, now)
+			entries.extend({**entry, 'source': source_name} for entry in cell_entries)
+			total += cell_total
+			for tag, count in cell_tags.items():
+				tag_counts[tag] = tag_counts.get(tag, 0) + count
+		return entries, total, tag_counts
+
+	def load_entries(self, entries):
+		items = []
+		errors = []
+		for item, error in self.iter_entries(entries):
+			if error is None:
+				items.append(item)
+			else:
+				errors.append(error)
+		return items, errors
+
+	def generation(self):
+		return read_generation(self.path)
+
+	def reveal_times(self, source_names, now):
+		times = [
+			self.cell_index(source_name).reveal_times(now)
+			for source_name in source_names]
+		last = max((last for last, _ in times if last is not None), default=None)
+		upcoming = min((upcoming for _, upcoming in times if upcoming is not None), default=None)
+		return last, upcoming
+
+	def deactivate_items(self, item_keys):
+		count = 0
+		for source_name, item_id in item_keys:
+			item = self.load_item(source_name, item_id)
+			if item['active']:
+				item['active'] = False
+				count += 1
+		return count
+
+	def expired_item_ids(self, cell_name, now):
+		return self.cell_index(cell_name).expired(now)
+
+	def deletion_candidates(self, source_name, item_ids, now):
+		index = self.cell_index(source_name)
+		candidates = []
+		for item_id in item_ids:
+			# Entries written with a digest also have the ttl and ttd, so
+			# only the items they show are expired need to be read.
+			entry = index.entries.get(item_id)
+			if entry is not None and 'digest' in entry and not is_expired(entry, now):
+				continue
+			try:
+				item = self.load_item(source_name, item_id)
+			except FileNotFoundError:
+				continue
+			if is_expired(item, now):
+				candidates.append(item)
+		return candidates
+
+	def export_cell(self, cell_name):
+		try:
+			state = self.load_state(cell_name).item
+		except FileNotFoundError:
+			state = {}
+		items, errors = self.load_items(cell_name)
+		for filename in errors:
+			logger.warning(f'Could not read {cell_name}/{filename}')
+		return state, (item.item for item in items.values())
+
+	def import_cell(self, cell_name, state, items):
+		self.ensure_cell(cell_name)
+		WritethroughDict(os.path.join(self.cell_path(cell_name), 'state'), state).flush()
+		count = 0
+		for item in items:
+			wd = WritethroughDict(self.item_path(cell_name, item['id']), item)
+			wd.encoding = self.cell_encoding(cell_name)
+			wd.flush()
+			count += 1
+		self.rebuild_manifest(cell_name)
+		return count
@@ -0,0 +1,234 @@
+import heapq
+import json
+import os
+import threading
+
+
+# The expiry and reveal heaps are rebuilt once they hold this many more
+# stale pairs than live ones.
+HEAP_SLACK = 1000
+
+
+def show_time(item):
+	"""
+	Returns the time from which an item hidden by a time-to-show is shown,
+	or None if it has no time-to-show.
+	"""
+	return item['created'] + item['tts'] if 'tts' in item else None
+
+
+def expiry(item):
+	"""
+	Returns the time from which an item is removed when its source does not
+	fetch it, or None if it is not removed.
+	"""
+	ttl_date = item['created'] + item['ttl'] if 'ttl' in item else None
+	if not item['active']:
+		return ttl_date or 0
+	if 'ttd' in item:
+		ttd_date = item['created'] + item['ttd']
+		return max(ttd_date, ttl_date) if ttl_date else ttd_date
+	return None
+
+
+class CellIndex():
+	"""
+	A cell's manifest held in memory, with an inverted index from each tag
+	to the ids of the visible active items that have it. Items hidden by a
+	time-to-show wait in a schedule ordered by show time, and are moved
+	into the tag index as their show times pass. The index follows the
+	manifest log: each refresh replays only the records appended since the
+	last one, so it reflects items created, updated and deleted by any
+	process. If the log is replaced by a compaction or rebuild, it is read
+	again from the start.
+	"""
+
+	def __init__(self, manifest_path):
+		self.manifest_path = manifest_path
+		self.lock = threading.Lock()
+		self.reset(None)
+
+	def reset(self, inode):
+		self.inode = inode
+		self.offset = 0
+		self.lines = 0
+		# id -> manifest entry
+		self.entries = {}
+		# ids of visible active items
+		self.visible = set()
+		# tag -> ids of visible active items with that tag
+		self.tags = {}
+		# id -> show time of active items with a time-to-show
+		self.show_times = {}
+		# ids of active items whose show time had not passed at the last
+		# reveal, and (show time, id) for each of them, along with stale
+		# pairs for items that have since changed
+		self.hidden = set()
+		self.schedule = []
+		# (-show time, id) for the visible items with a time-to-show, along
+		# with stale pairs
+		self.revealed = []
+		# id -> time from which the item is removed if it is not fetched
+		self.expiries = {}
+		# (expiry, id) for the items in expiries, along with stale pairs
+		# for items that have since changed
+		self.expiry_heap = []
+
+	def refresh(self):
+		"""
+		Applies any records appended to the manifest since the last refresh.
+		Raises FileNotFoundError if there is no manifest.
+		"""
+		with self.lock:
+			with open(self.manifest_path, 'rb') as f:
+				stat = os.fstat(f.fileno())
+				if stat.st_ino != self.inode or stat.st_size < self.offset:
+					self.reset(stat.st_ino)
+				f.seek(self.offset)
+				data = f.read()
+			# A trailing partial line is left for the next refresh
+			end = data.rfind(b'\n') + 1
+			for line in data[:end].splitlines():
+				self.lines += 1
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue
+				self.apply(record)
+			self.offset += end
+
+	def apply(self, record):
+		item_id = record['id']
+		old = self.entries.pop(item_id, None)
+		if old and old['active']:
+			self.show_times.pop(item_id, None)
+			self.hidden.discard(item_id)
+			if item_id in self.visible:
+				self.visible.discard(item_id)
+				for tag in old['tags']:
+					tagged = self.tags[tag]
+					tagged.discard(item_id)
+					if not tagged:
+						del self.tags[tag]
+		previous = self.expiries.pop(item_id, None)
+		if record.get('deleted'):
+			return
+		self.entries[item_id] = record
+		# Entries written before the manifest recorded the ttl and ttd are
+		# always due, so that the item itself is checked.
+		deadline = expiry(record) if 'digest' in record else 0
+		if deadline is not None:
+			self.expiries[item_id] = deadline
+			# An unchanged deadline is already in the heap
+			if deadline != previous:
+				heapq.heappush(self.expiry_heap, (deadline, item_id))
+			if len(self.expiry_heap) > 2 * len(self.expiries) + HEAP_SLACK:
+				self.expiry_heap = [(deadline, item_id) for item_id, deadline in self.expiries.items()]
+				heapq.heapify(self.expiry_heap)
+		if not record['active']:
+			return
+		# The time-to-show field hides items until an expiry date. Items
+		# are scheduled even if it has passed, and the next reveal shows
+		# them.
+		shows = show_time(record)
+		if shows is None:
+			self.show(item_id)
+			return
+		self.show_times[item_id] = shows
+		self.hidden.add(item_id)
+		heapq.heappush(self.schedule, (shows, item_id))
+		if len(self.schedule) > 2 * len(self.hidden) + HEAP_SLACK:
+			self.schedule = [(self.show_times[item_id], item_id) for item_id in self.hidden]
+			heapq.heapify(self.schedule)
+
+	def show(self, item_id):
+		self.visible.add(item_id)
+		for tag in self.entries[item_id]['tags']:
+			self.tags.setdefault(tag, set()).add(item_id)
+
+	def scheduled(self, pair):
+		shows, item_id = pair
+		return item_id in self.hidden and self.show_times[item_id] == shows
+
+	def reveal(self, now):
+		"""
+		Shows the hidden items whose show times have passed at `now`.
+		"""
+		while self.schedule and self.schedule[0][0] <= now:
+			pair = heapq.heappop(self.schedule)
+			if not self.scheduled(pair):
+				continue
+			shows, item_id = pair
+			self.hidden.discard(item_id)
+			self.show(item_id)
+			heapq.heappush(self.revealed, (-shows, item_id))
+		if len(self.revealed) > 2 * (len(self.show_times) - len(self.hidden)) + HEAP_SLACK:
+			self.revealed = [
+				(-shows, item_id)
+				for item_id, shows in self.show_times.items()
+				if item_id not in self.hidden]
+			heapq.heapify(self.revealed)
+
+	def query(self, only, exclude, now):
+		"""
+		Returns the entries of the visible active items that have a tag in
+		`only`, if given, and no tag in `exclude`, along with the number of
+		visible active items and the count of each tag among them.
+		"""
+		with self.lock:
+			self.reveal(now)
+			if only:
+				ids = set().union(*(self.tags.get(tag, ()) for tag in only))
+			else:
+				ids = set(self.visible)
+			for tag in exclude:
+				ids -= self.tags.get(tag, set())
+			counts = {tag: len(tagged) for tag, tagged in self.tags.items()}
+			entries = [self.entries[item_id] for item_id in ids]
+			return entries, len(self.visible), counts
+
+	def reveal_times(self, now):
+		"""
+		Returns the latest show time that has passed among active items
+		hidden by a time-to-show, and the next show time to come, or None
+		for either if there is none.
+		"""
+		with self.lock:
+			self.reveal(now)
+			# Stale pairs are dropped from the tops of the heaps
+			while self.revealed:
+				shows, item_id = self.revealed[0]
+				if item_id in self.visible and self.show_times.get(item_id) == -shows:
+					break
+				heapq.heappop(self.revealed)
+			while self.schedule and not self.scheduled(self.schedule[0]):
+				heapq.heappop(self.schedule)
+			last = -self.revealed[0][0] if self.revealed else None
+			upcoming = self.schedule[0][0] if self.schedule else None
+			return last, upcoming
+
+	def expired(self, now):
+		"""
+		Returns the ids of the items that are due to be removed at `now` if
+		their source does not fetch them.
+		"""
+		with self.lock:
+			due = {}
+			while self.expiry_heap and self.expiry_heap[0][0] <= now:
+				deadline, item_id = heapq.heappop(self.expiry_heap)
+				if self.expiries.get(item_id) == deadline:
+					due[item_id] = deadline
+			# The items stay in the index until they are deleted
+			for item_id, deadline in due.items():
+				heapq.heappush(self.expiry_heap, (deadline, item_id))
+			return list(due)
+
+	def entry(self, item_id):
+		"""Returns the manifest entry of an item, or None."""
+		with self.lock:
+			return self.entries.get(item_id)
+
+	def snapshot(self):
+		"""Returns a copy of the map of item ids to manifest entries."""
+		with self.lock:
+			return dict(self.entries)
@@ -0,0 +1,519 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+from inquisitor.configs import logger
+from inquisitor.storage.files import WritethroughDict, lock_files, item_digest
+from inquisitor.storage.index import expiry, show_time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cells (
+	name TEXT PRIMARY KEY,
+	state TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS items (
+	source TEXT NOT NULL,
+	id TEXT NOT NULL,
+	active INTEGER NOT NULL,
+	created NUMERIC,
+	time NUMERIC,
+	ttl NUMERIC,
+	ttd NUMERIC,
+	tts NUMERIC,
+	tags TEXT NOT NULL,
+	data TEXT NOT NULL,
+	digest TEXT,
+	expires NUMERIC,
+	shows NUMERIC,
+	PRIMARY KEY (source, id)
+);
+CREATE INDEX IF NOT EXISTS items_active ON items (active, source);
+CREATE INDEX IF NOT EXISTS items_created ON items (source, created);
+CREATE INDEX IF NOT EXISTS items_time ON items (source, time);
+CREATE TABLE IF NOT EXISTS item_tags (
+	source TEXT NOT NULL,
+	id TEXT NOT NULL,
+	tag TEXT NOT NULL,
+	PRIMARY KEY (source, id, tag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS item_tags_tag ON item_tags (tag, source);
+CREATE TABLE IF NOT EXISTS dungeon (
+	id INTEGER PRIMARY KEY CHECK (id = 0),
+	generation INTEGER NOT NULL,
+	modified NUMERIC
+);
+INSERT OR IGNORE INTO dungeon (id, generation) VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS items_insert_generation AFTER INSERT ON items BEGIN
+	UPDATE dungeon SET generation = generation + 1, modified = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+CREATE TRIGGER IF NOT EXISTS items_update_generation AFTER UPDATE ON items BEGIN
+	UPDATE dungeon SET generation = generation + 1, modified = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+CREATE TRIGGER IF NOT EXISTS items_delete_generation AFTER DELETE ON items BEGIN
+	UPDATE dungeon SET generation = generation + 1, modified = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+INSERT OR IGNORE INTO cells (name) VALUES ('inquisitor');
+"""
+
+# The columns indexed alongside the full item JSON
+ITEM_COLUMNS = (
+	'source', 'id', 'active', 'created', 'time', 'ttl', 'ttd', 'tts', 'tags', 'data',
+	'digest', 'expires', 'shows')
+ENTRY_COLUMNS = ('source', 'id', 'active', 'created', 'time', 'tts', 'tags')
+
+# Bumped when the schema needs existing rows to be backfilled
+SCHEMA_VERSION = 5
+
+
+class DatabaseDict(WritethroughDict):
+	"""A wrapper for a dictionary saved to a row in the database."""
+
+	def __init__(self, write, item, written=None):
+		self.path = None
+		self.fields = item
+		self.write = write
+		self.written = written
+		self.body_loaded = True
+
+	def flush(self):
+		s = json.dumps(self.item)
+		if s == self.written:
+			return
+		self.write(self.item)
+		self.written = s
+
+
+def item_row(item):
+	"""
+	Returns the column values storing an item.
+	"""
+	return (
+		item['source'],
+		item['id'],
+		1 if item['active'] else 0,
+		item.get('created'),
+		item.get('time'),
+		item.get('ttl'),
+		item.get('ttd'),
+		item.get('tts'),
+		json.dumps(item.get('tags', [])),
+		json.dumps(item),
+		item_digest(item),
+		expiry(item),
+		show_time(item),
+	)
+
+
+def tag_rows(item):
+	"""
+	Returns the (source, id, tag) rows indexing an item's tags.
+	"""
+	return [(item['source'], item['id'], tag) for tag in item.get('tags', [])]
+
+
+def row_entry(row):
+	"""
+	Returns the manifest entry for a row of ENTRY_COLUMNS.
+	"""
+	source, item_id, active, created, time, tts, tags = row
+	entry = {
+		'source': source,
+		'id': item_id,
+		'active': bool(active),
+		'created': created,
+		'tags': json.loads(tags),
+	}
+	if time is not None:
+		entry['time'] = time
+	if tts is not None:
+		entry['tts'] = tts
+	return entry
+
+
+class SqliteStorage():
+	"""
+	Stores the dungeon in a SQLite database, with one row per cell and one
+	row per item.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.local = threading.local()
+		# A forked process opens its own connections
+		os.register_at_fork(after_in_child=self.forget_connections)
+
+	def forget_connections(self):
+		self.local = threading.local()
+
+	def enable_cache(self, max_bytes):
+		# Items are read from the database's own page cache
+		logger.debug('The sqlite backend does not use an item cache')
+
+	def cache_stats(self):
+		return None
+
+	@property
+	def db(self):
+		"""The calling thread's connection to the database."""
+		if not hasattr(self.local, 'db'):
+			db = sqlite3.connect(self.path, timeout=30)
+			db.execute('PRAGMA journal_mode=WAL')
+			db.execute('PRAGMA synchronous=NORMAL')
+			db.executescript(SCHEMA)
+			version, = db.execute('PRAGMA user_version').fetchone()
+			if version < SCHEMA_VERSION:
+				with db:
+					if version < 1:
+						self.index_tags(db)
+					# Item digests have included a digest of the body
+					# rather than the body itself since version 5
+					if version < 5:
+						self.index_digests(db)
+					if version < 3:
+						self.index_expiries(db)
+					if version < 4:
+						self.index_show_times(db)
+					db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+			self.local.db = db
+		return self.local.db
+
+	@contextmanager
+	def transaction(self):
+		"""
+		Commits the writes made within it together. Transactions opened
+		within a transaction join the outer transaction.
+		"""
+		db = self.db
+		depth = getattr(self.local, 'depth', 0)
+		self.local.depth = depth + 1
+		try:
+			if depth:
+				yield db
+			else:
+				with db:
+					yield db
+		finally:
+			self.local.depth = depth
+
+	def lock_cells(self, cell_names):
+		return lock_files(f'{self.path}.{cell_name}.lock' for cell_name in cell_names)
+
+	def index_tags(self, db):
+		"""
+		Rebuilds the tag index from the items table.
+		"""
+		db.execute('DELETE FROM item_tags')
+		db.execute(
+			'INSERT OR IGNORE INTO item_tags (source, id, tag)'
+			' SELECT items.source, items.id, tags.value FROM items, json_each(items.tags) AS tags')
+
+	def index_digests(self, db):
+		"""
+		Adds the digest column to an items table created without it and
+		fills it in.
+		"""
+		columns = [row[1] for row in db.execute('PRAGMA table_info(items)')]
+		if 'digest' not in columns:
+			db.execute('ALTER TABLE items ADD COLUMN digest TEXT')
+		rows = db.execute('SELECT source, id, data FROM items').fetchall()
+		db.executemany(
+			'UPDATE items SET digest = ? WHERE source = ? AND id = ?',
+			[(item_digest(json.loads(data)), source, item_id) for source, item_id, data in rows])
+
+	def index_expiries(self, db):
+		"""
+		Adds the expiry column and its index to an items table created
+		without them and fills it in.
+		"""
+		columns = [row[1] for row in db.execute('PRAGMA table_info(items)')]
+		if 'expires' not in columns:
+			db.execute('ALTER TABLE items ADD COLUMN expires NUMERIC')
+		db.execute('CREATE INDEX IF NOT EXISTS items_expires ON items (source, expires)')
+		rows = db.execute('SELECT source, id, data FROM items').fetchall()
+		db.executemany(
+			'UPDATE items SET expires = ? WHERE source = ? AND id = ?',
+			[(expiry(json.loads(data)), source, item_id) for source, item_id, data in rows])
+
+	def index_show_times(self, db):
+		"""
+		Adds the show time column and its index to an items table created
+		without them and fills it in.
+		"""
+		columns = [row[1] for row in db.execute('PRAGMA table_info(items)')]
+		if 'shows' not in columns:
+			db.execute('ALTER TABLE items ADD COLUMN shows NUMERIC')
+		db.execute('CREATE INDEX IF NOT EXISTS items_shows ON items (source, shows) WHERE active = 1')
+		db.execute('UPDATE items SET shows = created + tts WHERE tts IS NOT NULL')
+
+	def write_tags(self, db, items):
+		"""
+		Replaces the tag index rows of the given items.
+		"""
+		db.executemany(
+			'DELETE FROM item_tags WHERE source = ? AND id = ?',
+			[(item['source'], item['id']) for item in items])
+		db.executemany(
+			'INSERT OR IGNORE INTO item_tags (source, id, tag) VALUES (?, ?, ?)',
+			[row for item in items for row in tag_rows(item)])
+
+	def write_item(self, item):
+		placeholders = ', '.join('?' * len(ITEM_COLUMNS))
+		with self.transaction() as db:
+			db.execute(
+				f'INSERT OR REPLACE INTO items ({", ".join(ITEM_COLUMNS)}) VALUES ({placeholders})',
+				item_row(item))
+			self.write_tags(db, [item])
+
+	def item_dict(self, item, written=None):
+		"""
+		Wraps an item so that writes to it replace its row.
+		"""
+		source_name, item_id = item['source'], item['id']
+		def write(item):
+			# The item is written under the key it was loaded with
+			self.write_item({**item, 'source': source_name, 'id': item_id})
+		return DatabaseDict(write, item, written)
+
+	def get_cells(self):
+		rows = self.db.execute(
+			'SELECT name FROM cells UNION SELECT DISTINCT source FROM items')
+		return [name for name, in rows]
+
+	def cell_exists(self, cell_name):
+		row = self.db.execute(
+			'SELECT 1 FROM cells WHERE name = ?', (cell_name,)).fetchone()
+		return row is not None
+
+	def ensure_cell(self, cell_name):
+		if not self.cell_exists(cell_name):
+			logger.info(f'Creating cell for source "{cell_name}"')
+			with self.transaction() as db:
+				db.execute('INSERT OR IGNORE INTO cells (name) VALUES (?)', (cell_name,))
+
+	def load_state(self, cell_name):
+		row = self.db.execute(
+			'SELECT state FROM cells WHERE name = ?', (cell_name,)).fetchone()
+		if row is None:
+			raise FileNotFoundError(f'No cell named {cell_name}')
+		def write(state):
+			with self.transaction() as db:
+				db.execute(
+					'UPDATE cells SET state = ? WHERE name = ?',
+					(json.dumps(state), cell_name))
+		return DatabaseDict(write, json.loads(row[0]), row[0])
+
+	def load_item(self, source_name, item_id):
+		row = self.db.execute(
+			'SELECT data FROM items WHERE source = ? AND id = ?',
+			(source_name, item_id)).fetchone()
+		if row is None:
+			raise FileNotFoundError(f'No item {source_name}/{item_id}')
+		return self.item_dict(json.loads(row[0]), row[0])
+
+	def item_exists(self, source_name, item_id):
+		row = self.db.execute(
+			'SELECT 1 FROM items WHERE source = ? AND id = ?',
+			(source_name, item_id)).fetchone()
+		return row is not None
+
+	def get_item_ids(self, cell_name):
+		rows = self.db.execute(
+			'SELECT id FROM items WHERE source = ?', (cell_name,))
+		return [item_id for item_id, in rows]
+
+	def create_item(self, item):
+		placeholders = ', '.join('?' * len(ITEM_COLUMNS))
+		try:
+			with self.transaction() as db:
+				db.execute(
+					f'INSERT INTO items ({", ".join(ITEM_COLUMNS)}) VALUES ({placeholders})',
+					item_row(item))
+				self.write_tags(db, [item])
+		except sqlite3.IntegrityError:
+			raise FileExistsError(f'{item["source"]}/{item["id"]}')
+		return self.item_dict(item, json.dumps(item))
+
+	def delete_item(self, source_name, item_id):
+		with self.transaction() as db:
+			cursor = db.execute(
+				'DELETE FROM items WHERE source = ? AND id = ?',
+				(source_name, item_id))
+			db.execute(
+				'DELETE FROM item_tags WHERE source = ? AND id = ?',
+				(source_name, item_id))
+		if not cursor.rowcount:
+			raise FileNotFoundError(f'No item {source_name}/{item_id}')
+
+	def iter_items(self, cell_names):
+		for cell_name in cell_names:
+			rows = self.db.execute(
+				'SELECT id, data FROM items WHERE source = ?', (cell_name,))
+			for item_id, data in rows:
+				try:
+					yield self.item_dict(json.loads(data), data), None
+				except Exception:
+					yield None, f'{cell_name}/{item_id}'
+
+	def iter_entries(self, entries):
+		for entry in entries:
+			try:
+				yield self.load_item(entry['source'], entry['id']), None
+			except Exception:
+				yield None, f'{entry["source"]}/{entry["id"]}'
+
+	def load_items(self, source_name):
+		items = {}
+		errors = []
+		rows = self.db.execute(
+			'SELECT id, data FROM items WHERE source = ?', (source_name,))
+		for item_id, data in rows:
+			try:
+				items[item_id] = self.item_dict(json.loads(data), data)
+			except Exception:
+				errors.append(item_id)
+		return items, errors
+
+	def reindex(self, cell_name):
+		with self.transaction() as db:
+			db.execute('REINDEX items')
+			self.index_tags(db)
+		return len(self.get_item_ids(cell_name)), []
+
+	def load_manifest(self, cell_name):
+		rows = self.db.execute(
+			'SELECT id, active, created, ttl, ttd, digest FROM items WHERE source = ?',
+			(cell_name,))
+		entries = {}
+		for item_id, active, created, ttl, ttd, digest in rows:
+			entry = {'id': item_id, 'active': bool(active), 'created': created, 'digest': digest}
+			if ttl is not None:
+				entry['ttl'] = ttl
+			if ttd is not None:
+				entry['ttd'] = ttd
+			entries[item_id] = entry
+		return entries
+
+	def load_active_entries(self, source_names, now):
+		placeholders = ', '.join('?' * len(source_names))
+		rows = self.db.execute(
+			f'SELECT {", ".join(ENTRY_COLUMNS)} FROM items'
+			f' WHERE active = 1 AND source IN ({placeholders})'
+			' AND (shows IS NULL OR shows <= ?)',
+			(*source_names, now))
+		return [row_entry(row) for row in rows]
+
+	def query_entries(self, source_names, only, exclude, now):
+		sources = ', '.join('?' * len(source_names))
+		visible = (
+			f'items.active = 1 AND items.source IN ({sources})'
+			' AND (items.shows IS NULL OR items.shows <= ?)')
+		params = [*source_names, now]
+		where = visible
+		tagged = (
+			'SELECT 1 FROM item_tags WHERE item_tags.source = items.source'
+			' AND item_tags.id = items.id AND item_tags.tag IN ({})')
+		if only:
+			where += ' AND EXISTS ({})'.format(tagged.format(', '.join('?' * len(only))))
+			params.extend(only)
+		if exclude:
+			where += ' AND NOT EXISTS ({})'.format(tagged.format(', '.join('?' * len(exclude))))
+			params.extend(exclude)
+		columns = ', '.join(f'items.{column}' for column in ENTRY_COLUMNS)
+		entries = [
+			row_entry(row)
+			for row in self.db.execute(f'SELECT {columns} FROM items WHERE {where}', params)]
+		total, = self.db.execute(
+			f'SELECT COUNT(*) FROM items WHERE {visible}',
+			(*source_names, now)).fetchone()
+		tag_counts = dict(self.db.execute(
+			'SELECT item_tags.tag, COUNT(*) FROM items JOIN item_tags'
+			' ON item_tags.source = items.source AND item_tags.id = items.id'
+			f' WHERE {visible} GROUP BY item_tags.tag',
+			(*source_names, now)))
+		return entries, total, tag_counts
+
+	def load_entries(self, entries):
+		items = []
+		errors = []
+		for entry in entries:
+			try:
+				items.append(self.load_item(entry['source'], entry['id']))
+			except Exception:
+				errors.append(f'{entry["source"]}/{entry["id"]}')
+		return items, errors
+
+	def generation(self):
+		generation, modified = self.db.execute(
+			'SELECT generation, modified FROM dungeon').fetchone()
+		return generation, modified
+
+	def reveal_times(self, source_names, now):
+		placeholders = ', '.join('?' * len(source_names))
+		last, = self.db.execute(
+			'SELECT MAX(shows) FROM items'
+			f' WHERE active = 1 AND source IN ({placeholders}) AND shows <= ?',
+			(*source_names, now)).fetchone()
+		upcoming, = self.db.execute(
+			'SELECT MIN(shows) FROM items'
+			f' WHERE active = 1 AND source IN ({placeholders}) AND shows > ?',
+			(*source_names, now)).fetchone()
+		return last, upcoming
+
+	def deactivate_items(self, item_keys):
+		with self.transaction() as db:
+			cursor = db.executemany(
+				'UPDATE items SET active = 0,'
+				" data = json_set(data, '$.active', json('false')),"
+				' expires = CASE WHEN ttl IS NULL THEN 0 ELSE created + ttl END'
+				' WHERE source = ? AND id = ? AND active = 1',
+				item_keys)
+		return cursor.rowcount
+
+	def expired_item_ids(self, cell_name, now):
+		rows = self.db.execute(
+			'SELECT id FROM items WHERE source = ? AND expires <= ?',
+			(cell_name, now))
+		return [item_id for item_id, in rows]
+
+	def deletion_candidates(self, source_name, item_ids, now):
+		# Inactive items unprotected by a ttl, and items past their ttd
+		self.db.execute('CREATE TEMP TABLE IF NOT EXISTS candidate_ids (id TEXT PRIMARY KEY)')
+		with self.transaction() as db:
+			db.execute('DELETE FROM candidate_ids')
+			db.executemany(
+				'INSERT OR IGNORE INTO candidate_ids (id) VALUES (?)',
+				((item_id,) for item_id in item_ids))
+			rows = db.execute(
+				'SELECT data FROM items'
+				' WHERE source = ? AND id IN (SELECT id FROM candidate_ids)'
+				' AND (ttl IS NULL OR created + ttl <= ?)'
+				' AND (active = 0 OR (ttd IS NOT NULL AND created + ttd < ?))',
+				(source_name, now, now)).fetchall()
+		return [self.item_dict(json.loads(data), data) for data, in rows]
+
+	def export_cell(self, cell_name):
+		try:
+			state = self.load_state(cell_name).item
+		except FileNotFoundError:
+			state = {}
+		rows = self.db.execute(
+			'SELECT data FROM items WHERE source = ?', (cell_name,))
+		return state, (json.loads(data) for data, in rows)
+
+	def import_cell(self, cell_name, state, items):
+		items = [{**item, 'source': cell_name} for item in items]
+		rows = [item_row(item) for item in items]
+		placeholders = ', '.join('?' * len(ITEM_COLUMNS))
+		with self.transaction() as db:
+			db.execute(
+				'INSERT OR REPLACE INTO cells (name, state) VALUES (?, ?)',
+				(cell_name, json.dumps(state)))
+			db.executemany(
+				f'INSERT OR REPLACE INTO items ({", ".join(ITEM_COLUMNS)}) VALUES ({placeholders})',
+				rows)
+			self.write_tags(db, items)
+		return len(rows)
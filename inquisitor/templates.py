@@ -2,40 +2,50 @@
 Generates a dummy item.
 """
 # Standard library imports
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import inspect
 import logging
 import os
 import random
-from time import sleep
+import re
 import sys
+import threading
+import time
+from urllib.parse import urlsplit
 
 # Third-party library imports
 from bs4 import BeautifulSoup
-import requests
 
 # Module imports
-from inquisitor import CACHE_PATH
+from inquisitor.configs import HTTP_TIMEOUT, HTTP_HOST_CONNECTIONS
+from inquisitor.filecache import file_cache
+from inquisitor.sessions import PooledSession, session
 
 logger = logging.getLogger('inquisitor.templates')
 
+# Seconds between requests to Reddit, which allows an OAuth client 100 a
+# minute, from the instances of a parallel fetch
+REDDIT_INTERVAL = 0.6
+
 
 def cache_image(source, url, filename):
-	# Define some paths
-	path = os.path.join(CACHE_PATH, source)
-	file_path = os.path.join(path, filename)
-	cached_url = f'/cache/{source}/{filename}'
-	# Ensure cache folder
-	if not os.path.isdir(path):
-		os.mkdir(path)
-	# Fetch url
-	logger.info(f'Caching {url} to {file_path}')
-	response = requests.get(url)
-	# Write file to disk
-	with open(file_path, 'wb') as f:
-		f.write(response.content)
-	# Return the inquisitor path to the file
-	return cached_url
+	"""
+	Caches the file at a URL and returns the inquisitor path to it. Files
+	are stored by content, so `filename` only provides the extension, and
+	a URL that was already cached is not downloaded again.
+	"""
+	_, ext = os.path.splitext(filename)
+	if not re.fullmatch(r'\.\w{1,16}', ext):
+		ext = ''
+	logger.debug(f'Caching {url} for {source}')
+	path = file_cache.fetch(url, ext)
+	return f'/cache/{path}'
+
+
+# When each host may next be crawled, shared by the crawlers in this process
+crawl_schedule = {}
+crawl_schedule_lock = threading.Lock()
 
 
 class LinearCrawler:
@@ -49,7 +59,9 @@ class LinearCrawler:
 		new = self.try_fetch(state)
 		items.extend(new)
 		for iter in range(max_iter):
-			sleep(1)
+			# Cut out early if there was nothing returned
+			if not new:
+				break
 			# If we've already gotten some items out of this fetch, we don't
 			# want to lose them and have the state still be set to the next
 			# page, so we wrap further calls in a try block and force return
@@ -59,18 +71,28 @@ class LinearCrawler:
 			except:
 				new = []
 			items.extend(new)
-			# Cut out early if there was nothing returned
-			if not new:
-				break
 		return items
 
 	def try_fetch(self, state):
 		# Check for whether a new page should be crawled
 		if 'current_page' not in state:
 			next_page = self.get_start_url()
+		elif state.get('next_page'):
+			# The link to the next page was found when the current page was
+			# crawled, so the current page doesn't need to be fetched again
+			next_page = state['next_page']
 		else:
+			# Check the current page for a new link, unless it is unchanged
 			current = state['current_page']
-			response = requests.get(current)
+			headers = {}
+			if state.get('current_page_etag'):
+				headers['If-None-Match'] = state['current_page_etag']
+			if state.get('current_page_modified'):
+				headers['If-Modified-Since'] = state['current_page_modified']
+			response = self.get(current, headers=headers)
+			self.update_validators(state, response)
+			if response.status_code == 304:
+				return []  # nothing new
 			soup = BeautifulSoup(response.text, features='html.parser')
 			next_page = self.get_next_page_url(current, soup)
 		if not next_page:
@@ -78,16 +100,63 @@ class LinearCrawler:
 
 		# Download the new page
 		logger.info('Fetching ' + next_page)
-		response = requests.get(next_page)
+		response = self.get(next_page)
 		soup = BeautifulSoup(response.text, features="html.parser")
 
 		# Create an item from the page
 		item = self.make_item(next_page, soup)
 
+		# Look ahead for the page after this one, which the latest page
+		# won't have yet
+		try:
+			following = self.get_next_page_url(next_page, soup)
+		except Exception:
+			following = None
+
 		# Update the state and return the item
 		state['current_page'] = next_page
+		state['next_page'] = following
+		state['current_page_etag'] = response.headers.get('ETag')
+		state['current_page_modified'] = response.headers.get('Last-Modified')
 		return [item]
 
+	def update_validators(self, state, response):
+		"""
+		Saves the validators of a response for the current page. A response
+		may leave out a validator, such as a 304 that only repeats the ETag,
+		so only the validators it includes replace the saved ones.
+		"""
+		if response.headers.get('ETag'):
+			state['current_page_etag'] = response.headers['ETag']
+		if response.headers.get('Last-Modified'):
+			state['current_page_modified'] = response.headers['Last-Modified']
+
+	def get(self, url, **kwargs):
+		"""
+		Fetches a page through the shared session, after waiting out the
+		crawl delay for its host.
+		"""
+		host = urlsplit(url).netloc
+		with crawl_schedule_lock:
+			start = max(time.monotonic(), crawl_schedule.get(host, 0))
+			crawl_schedule[host] = start
+		delay = start - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+		response = session.get(url, **kwargs)
+		delay = self.crawl_delay(response.elapsed.total_seconds())
+		with crawl_schedule_lock:
+			crawl_schedule[host] = max(crawl_schedule[host], time.monotonic() + delay)
+		return response
+
+	def crawl_delay(self, elapsed):
+		"""
+		Returns the seconds to wait before crawling the same host again,
+		given how long its last response took, so that slower servers are
+		crawled more gently.
+		"""
+		return min(max(0.5, 2 * elapsed), 10)
+
 	def max_iterations(self):
 		return 3
 
@@ -108,17 +177,73 @@ class RedditScraper:
 	fetch new with RedditScraper.fetch_new(state, __name__, reddit)
 	"""
 	@staticmethod
-	def fetch_new(state, name, reddit):
-		items = []
-		for name, obj in inspect.getmembers(sys.modules[name]):
+	def fetch_new(state, name, reddit, workers=4):
+		"""
+		Fetches the subreddits of every RedditScraper in a module. PRAW is
+		not thread-safe, so a Reddit instance is only used by one thread:
+		if `reddit` is an instance, the subreddits are fetched one after
+		another with it. If it is a function that passes its keyword
+		arguments on to a new instance, such as
+		`lambda **kwargs: praw.Reddit(..., **kwargs)` with the source's
+		credentials, they are fetched on a pool of `workers` threads, each
+		with its own instance. The instances send their requests through
+		one rate-limited session, so together they keep to the quota of a
+		single client. A subreddit that fails is logged and skipped, unless
+		they all fail.
+		"""
+		scraper_classes = [
+			obj
+			for name, obj in inspect.getmembers(sys.modules[name])
 			if (inspect.isclass(obj)
 				and issubclass(obj, RedditScraper)
-				and obj is not RedditScraper
-			):
-				sub_items = obj(reddit).get_items()
-				items.extend(sub_items)
+				and obj is not RedditScraper)
+		]
+		if not scraper_classes:
+			return []
+		if hasattr(reddit, 'subreddit') and not isinstance(reddit, type):
+			results = RedditScraper.fetch_serial(scraper_classes, reddit)
+		else:
+			results = RedditScraper.fetch_parallel(scraper_classes, reddit, workers)
+		items = []
+		errors = []
+		for scraper_class, result in zip(scraper_classes, results):
+			try:
+				items.extend(result())
+			except Exception as e:
+				logger.error(f'Could not fetch r/{scraper_class.subreddit_name}: {e}')
+				errors.append(e)
+		if len(errors) == len(scraper_classes):
+			raise errors[0]
 		return items
 
+	@staticmethod
+	def fetch_serial(scraper_classes, reddit):
+		"""Yields a function returning the items of each scraper in turn."""
+		for scraper_class in scraper_classes:
+			yield scraper_class(reddit).get_items
+
+	@staticmethod
+	def fetch_parallel(scraper_classes, make_reddit, workers):
+		"""
+		Yields a function returning the items of each scraper, fetched on a
+		thread pool where each thread makes its own Reddit instance. Each
+		instance tracks its own quota, so they share a session that spaces
+		out their requests. PRAW retries on its own, so the session doesn't.
+		"""
+		reddit_session = PooledSession(
+			HTTP_TIMEOUT, 0, HTTP_HOST_CONNECTIONS, REDDIT_INTERVAL)
+		local = threading.local()
+		def fetch(scraper_class):
+			if not hasattr(local, 'reddit'):
+				local.reddit = make_reddit(requestor_kwargs={'session': reddit_session})
+			return scraper_class(local.reddit).get_items()
+		with reddit_session, ThreadPoolExecutor(
+			max_workers=min(workers, len(scraper_classes)),
+			thread_name_prefix='reddit') as pool:
+			futures = [pool.submit(fetch, scraper_class) for scraper_class in scraper_classes]
+			for future in futures:
+				yield future.result
+
 	def __init__(self, reddit):
 		self.reddit = reddit
 
@@ -143,7 +268,6 @@ class RedditScraper:
 			'author': '/u/' + (post.author.name if post.author else "[deleted]"),
 			'body': self.get_body(post),
 			'tags': self.get_tags(post),
-			'ttl': self.get_ttl(post),
 		}
 		ttl = self.get_ttl(post)
 		if ttl is not None: item['ttl'] = ttl